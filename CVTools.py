@@ -18,6 +18,14 @@ def base64CV(img_raw_base64):
     img_array = np.fromstring(img_b64decode, np.uint8)  # 转换np序列
     img_opencv = cv2.imdecode(img_array, cv2.IMREAD_COLOR)  # 转换Opencv格式 BGR
     return img_opencv
+def dHash(img,hashSize=8):
+    # difference hash of a thumbnail, robust to re-compress and small resize
+    gray=img if len(img.shape)==2 else cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+    thumb=cv2.resize(gray,(hashSize+1,hashSize),interpolation=cv2.INTER_AREA)
+    bits=(thumb[:,1:]>thumb[:,:-1]).flatten()
+    return int(''.join(['1' if b else '0' for b in bits]),2)
+def hammingDistance(hash1,hash2):
+    return bin(hash1^hash2).count('1')
 def landmarkCenter(landmark):
     # height=np.max(landmark[:,1])-np.min(landmark[:,1])
     # width=np.max(landmark[:,0])-np.min(landmark[:,0])
@@ -34,15 +42,119 @@ def addWeight(fg,bg,ratio,mask=None,gamma=0):
     else:
         result=fg*ratio*0.5+bg*ratio*0.5+gamma
     return result
+def addWeightU8(fg,bg,ratio,mask=None,gamma=0):
+    # uint8 version of addWeight: integer blend only inside the box of the mask, a LUT applies ratio and gamma.
+    # the result is rounded to uint8, at most 1 from np.round(addWeight(...))
+    lut=np.array(np.clip(np.round(np.arange(256)*ratio+gamma),0,255),'uint8')
+    if mask is None:
+        return cv2.LUT(cv2.addWeighted(fg,0.5,bg,0.5,0),lut)
+    result=cv2.LUT(bg,lut)# mask==0: bg*ratio+gamma
+    x,y,w,h=cv2.boundingRect(mask if len(mask.shape)==2 else mask[:,:,0])
+    if w==0 or h==0:
+        return result
+    m=mask[y:y+h,x:x+w]
+    if len(m.shape)==2 and len(fg.shape)==3:
+        m=m[:,:,np.newaxis]
+    m=m.astype('uint16')
+    blend=fg[y:y+h,x:x+w].astype('uint16')*m
+    blend+=bg[y:y+h,x:x+w].astype('uint16')*(255-m)# at most 255*255, fits uint16
+    blend+=127
+    blend//=255
+    result[y:y+h,x:x+w]=cv2.LUT(blend.astype('uint8'),lut)
+    return result
+def classBox(pred,classIndex):
+    # bounding box [x1,y1,x2,y2] of the pixels of classIndex in the seg result, None if there is none
+    x,y,w,h=cv2.boundingRect(np.array(pred==classIndex,'uint8'))
+    if w==0 or h==0:
+        return None
+    return [x,y,x+w,y+h]
+def maskedMerge(src,dst,pred,classIndex,bbox=None,inside=True):
+    # dst=src where pred==classIndex (inside=False: where pred!=classIndex), in place and only inside bbox [x1,y1,x2,y2]
+    # src is either the size of dst or the size of the bbox
+    if bbox is None:
+        bbox=[0,0,dst.shape[1],dst.shape[0]]
+    x1,y1=max(int(bbox[0]),0),max(int(bbox[1]),0)
+    x2,y2=min(int(bbox[2]),dst.shape[1]),min(int(bbox[3]),dst.shape[0])
+    if x2<=x1 or y2<=y1:
+        return dst
+    if src.shape[:2]==dst.shape[:2]:
+        src=src[y1:y2,x1:x2]
+    select=pred[y1:y2,x1:x2]==classIndex
+    if not inside:
+        select=~select
+    roi=dst[y1:y2,x1:x2]
+    np.copyto(roi,src,where=select[:,:,np.newaxis] if len(roi.shape)==3 else select)
+    return dst
+def changedBoxes(before,after,threshold=0,margin=8,maxBoxes=8):
+    # boxes [x1,y1,x2,y2] of the areas where after differs from before, nearby changes are merged by the dilate of margin
+    changed=np.array(cv2.absdiff(before,after).max(axis=2)>threshold,'uint8')
+    if margin>0:
+        changed=cv2.dilate(changed,np.ones((2*margin+1,2*margin+1),'uint8'))
+    nums,labels,stats,centroids=cv2.connectedComponentsWithStats(changed,connectivity=8)
+    boxes=[[int(x),int(y),int(x+w),int(y+h)] for x,y,w,h,area in stats[1:]]
+    if len(boxes)>maxBoxes:
+        # too many small patches, one box of all of them
+        boxes=np.array(boxes)
+        boxes=[[int(boxes[:,0].min()),int(boxes[:,1].min()),int(boxes[:,2].max()),int(boxes[:,3].max())]]
+    return boxes
+def flowGray(img,flowSize=320):
+    # small gray image for the optical flow, long side flowSize
+    ratio=min(1.0,flowSize/max(img.shape[:2]))
+    gray=cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+    if ratio<1:
+        gray=cv2.resize(gray,None,fx=ratio,fy=ratio,interpolation=cv2.INTER_AREA)
+    return gray
+def backFlow(prevGray,gray,shape):
+    # Farneback flow from the current frame to the previous one, at the size of shape: prev[y+fy,x+fx] ~ cur[y,x]
+    flow=cv2.calcOpticalFlowFarneback(gray,prevGray,None,0.5,3,15,3,5,1.2,0)
+    scaleX=shape[1]/float(gray.shape[1])
+    scaleY=shape[0]/float(gray.shape[0])
+    flow=cv2.resize(flow,(shape[1],shape[0]))
+    flow[:,:,0]*=scaleX
+    flow[:,:,1]*=scaleY
+    return flow
+def propagateMask(pred,flow):
+    # seg result of the previous frame warped to the current frame
+    height,width=flow.shape[:2]
+    mapX=flow[:,:,0]+np.arange(width,dtype='float32')[np.newaxis,:]
+    mapY=flow[:,:,1]+np.arange(height,dtype='float32')[:,np.newaxis]
+    return cv2.remap(np.array(pred,'uint8'),mapX,mapY,cv2.INTER_NEAREST,borderMode=cv2.BORDER_REPLICATE)
 def headAngle(landmark):
     noseX=(landmark[30,0]+landmark[29,0])/2
     faceX=(np.sum(landmark[0:3,0])+np.sum(landmark[14:17,0]))/6
     return np.array([(faceX-noseX),0])
+def minimizeInput(img,size):
+    # the longer side to size, the working size of the requests
+    ratio=size/max(img.shape[:2])
+    img=cv2.resize(img,None,fx=ratio,fy=ratio)
+    return img
 def resize(src,ratioX,ratioY,ratio):
     # mask = cv2.resize(mask, (int(src.shape[1] * ratio * ratioX), int(src.shape[0] * ratio * ratioY)))
     src = cv2.resize(src, (int(src.shape[1] * ratio * ratioX), int(src.shape[0] * ratio * ratioY)))
     return src
+def spritePyramid(src,levels=4,minSide=16):
+    # [(level shape,{False:sprite,True:flipped sprite})]: the native sprite and its 1/2,1/4.. downscales
+    pyramid=[]
+    level=src
+    for i in range(levels):
+        pyramid.append((level.shape[:2],{False:level,True:cv2.flip(level,1)}))
+        size=(level.shape[1]//2,level.shape[0]//2)
+        if min(size)<minSide:
+            break
+        level=cv2.resize(level,size,interpolation=cv2.INTER_AREA)
+    return pyramid
+def resizeFromPyramid(pyramid,ratioX,ratioY,ratio,flip=False):
+    # same size as resize() of the native sprite, resized from the smallest level still larger than the target
+    nativeShape=pyramid[0][0]
+    size=(int(nativeShape[1]*ratio*ratioX),int(nativeShape[0]*ratio*ratioY))
+    level=pyramid[0][1][flip]
+    for shape,sprites in pyramid:
+        if shape[1]>=size[0] and shape[0]>=size[1]:
+            level=sprites[flip]
+    return cv2.resize(level,size)
 def mask3Channel(mask,src):
+    if len(src.shape)==3 and src.shape[2]==3 and mask.dtype==src.dtype:
+        return cv2.merge((mask,mask,mask))
     maskPic = 255 * np.ones(src.shape, src.dtype)
     maskPic[:,:,0]=mask
     maskPic[:,:,1] = mask
@@ -63,15 +175,17 @@ def gradientMask(maskHead3,lowestValue=126,heightGradientBias=0.5):
     # gradient transparence of the head
 
     height=maskHead3.shape[0]
-    for i in range(height) :
-        # the value after linear gradient
-        if i/height>heightGradientBias:
-            afterGradient=int(255-(255-lowestValue)*(i-heightGradientBias*height)/(height*(1-heightGradientBias)))
-
-            maskHead3[i,:,:] = np.where(maskHead3[i,:,:]==255,afterGradient,0)
-
-    maskHead3=np.array(maskHead3,'uint8')
-    maskHead3=np.clip(maskHead3,0,255)
+    maskHead3=np.asarray(maskHead3,'uint8')
+    rows=np.arange(height)
+    gradientRows=np.flatnonzero(rows/height>heightGradientBias)
+    if len(gradientRows)==0:
+        return maskHead3
+    begin=gradientRows[0]
+    # the value after linear gradient of every row, same float math and int() truncation as per row
+    afterGradient=np.array(255-(255-lowestValue)*(rows[begin:]-heightGradientBias*height)/(height*(1-heightGradientBias)),'int64')
+    afterGradient=afterGradient.reshape((-1,)+(1,)*(len(maskHead3.shape)-1))
+    lower=maskHead3[begin:]
+    lower[...]=np.where(lower==255,np.array(afterGradient,'uint8'),np.uint8(0))
     return maskHead3
 def roiDst(dst,dstLM):
     x1=int(min(dstLM[:,0]))
@@ -159,8 +273,8 @@ def leftTop2Center(leftTop,src):
     return center
 def hardPaste(dstOri,newleftTop,newrightDown,maskHead3,srcHead):
     hardPaste1=dstOri[newleftTop[1]:newrightDown[1],newleftTop[0]:newrightDown[0],:]
-    hardPaste1=np.where(maskHead3==255,srcHead,hardPaste1)
-    dstOri[newleftTop[1]:newrightDown[1],newleftTop[0]:newrightDown[0],:]=hardPaste1
+    # in place on the roi view of dstOri
+    np.copyto(hardPaste1,srcHead,where=maskHead3==255)
     return dstOri
 def flipFace(headAngleBias,sideThreshold,srcLM,srcBody,srcLMHead,srcHead):
     if headAngleBias[0]>sideThreshold:## face to left-hand side
@@ -173,6 +287,107 @@ def splitMask(src):
     bgr=src[:,:,:3]
     transparent=src[:,:,3]
     return transparent,bgr
+## 各融合方式在sprite box外可能改变的像素范围
+cloneMargin=4
+featherMargin=8
+pyramidLevels=4
+def blendMargin(blendMode):
+    # how far outside the sprite box blendClone may change dst, e.g. for restoring pixels around it afterwards
+    if blendMode=='pyramid':
+        return 2**pyramidLevels
+    if blendMode=='feather':
+        return featherMargin
+    return cloneMargin
+def seamlessCloneROI(src,dst,mask,center,flags,margin=cloneMargin,out=None):
+    # seamlessClone on the dst crop around the sprite instead of the whole photo.
+    # opencv only solves inside the mask box placed at center, so the result is the same,
+    # but the cost depends on the sprite size. out: the buffer the patch is pasted to, default a copy of dst
+    h,w=src.shape[:2]
+    x1=max(0,center[0]-w//2-margin)
+    y1=max(0,center[1]-h//2-margin)
+    x2=min(dst.shape[1],center[0]+(w+1)//2+margin)
+    y2=min(dst.shape[0],center[1]+(h+1)//2+margin)
+    patch=cv2.seamlessClone(src,dst[y1:y2,x1:x2],mask,(center[0]-x1,center[1]-y1),flags)
+    if out is None:
+        out=dst.copy()
+    out[y1:y2,x1:x2]=patch
+    return out
+## blendMode of ConfigPet/ConfigHead: poisson(seamlessClone), pyramid(laplacian pyramid) or feather(feathered alpha)
+blendModes=['poisson','pyramid','feather']
+def blendClone(src,dst,mask,center,flags,blendMode='poisson',out=None):
+    if blendMode=='pyramid':
+        return pyramidBlend(src,dst,mask,center,out=out)
+    if blendMode=='feather':
+        return featherBlend(src,dst,mask,center,out=out)
+    return seamlessCloneROI(src,dst,mask,center,flags,out=out)
+def placeSprite(src,mask,center,dstShape,margin=0):
+    # same placement as seamlessClone: the box of the mask is centered at center.
+    # return sprite, alpha(float32 0~1) and their box [x1,y1,x2,y2] in dst, all padded by margin and clipped by dst
+    m=mask if len(mask.shape)==2 else mask[:,:,0]
+    x,y,w,h=cv2.boundingRect(m)
+    left,top=center[0]-w//2,center[1]-h//2
+    x1,y1=max(0,left-margin),max(0,top-margin)
+    x2,y2=min(dstShape[1],left+w+margin),min(dstShape[0],top+h+margin)
+    sprite=np.zeros((y2-y1,x2-x1,3),'float32')
+    alpha=np.zeros((y2-y1,x2-x1),'float32')
+    # part of the mask box inside the dst
+    sx1,sy1=x+max(0,x1-left),y+max(0,y1-top)
+    sx2,sy2=x+min(w,x2-left),y+min(h,y2-top)
+    px,py=max(0,left-x1),max(0,top-y1)
+    sprite[py:py+sy2-sy1,px:px+sx2-sx1]=src[sy1:sy2,sx1:sx2,:3]
+    alpha[py:py+sy2-sy1,px:px+sx2-sx1]=m[sy1:sy2,sx1:sx2]/255.0
+    return sprite,alpha,[x1,y1,x2,y2]
+def matchColor(sprite,alpha,background,strength=0.6):
+    # move the lab mean/std of the sprite toward the background under it (reinhard), strength 0~1
+    inside=alpha>0.5
+    outside=alpha<0.05
+    if np.count_nonzero(inside)<16 or np.count_nonzero(outside)<16:
+        return sprite
+    spriteLab=cv2.cvtColor(sprite/255.0,cv2.COLOR_BGR2Lab)
+    backLab=cv2.cvtColor(background/255.0,cv2.COLOR_BGR2Lab)
+    meanS,stdS=spriteLab[inside].mean(0),spriteLab[inside].std(0)+1e-3
+    meanB,stdB=backLab[outside].mean(0),backLab[outside].std(0)+1e-3
+    scale=np.clip(stdB/stdS,0.5,2)
+    matched=(spriteLab-meanS)*scale+meanB
+    spriteLab=spriteLab+strength*(matched-spriteLab)
+    return np.clip(cv2.cvtColor(spriteLab.astype('float32'),cv2.COLOR_Lab2BGR)*255,0,255)
+def featherBlend(src,dst,mask,center,featherRatio=0.08,colorMatch=0.6,out=None):
+    # alpha blend with a soft edge inside the mask, much cheaper than the poisson solve
+    sprite,alpha,(x1,y1,x2,y2)=placeSprite(src,mask,center,dst.shape,featherMargin)
+    background=np.float32(dst[y1:y2,x1:x2])
+    k=max(3,int(featherRatio*min(src.shape[:2]))|1)
+    alpha=cv2.GaussianBlur(cv2.erode(alpha,np.ones((k//2+1,k//2+1),np.uint8)),(k,k),0)
+    if colorMatch>0:
+        sprite=matchColor(sprite,alpha,background,colorMatch)
+    alpha=alpha[:,:,np.newaxis]
+    if out is None:
+        out=dst.copy()
+    out[y1:y2,x1:x2]=np.clip(sprite*alpha+background*(1-alpha)+0.5,0,255).astype('uint8')
+    return out
+def pyramidBlend(src,dst,mask,center,levels=pyramidLevels,out=None):
+    # laplacian pyramid blend: low frequency mixed over a wide band, details keep a sharp edge
+    margin=2**levels
+    sprite,alpha,(x1,y1,x2,y2)=placeSprite(src,mask,center,dst.shape,margin)
+    background=np.float32(dst[y1:y2,x1:x2])
+    levels=max(1,min(levels,int(np.log2(max(2,min(alpha.shape))))-3))
+    # outside the mask the sprite is the background, so the blend is only around the edge
+    sprite=sprite*alpha[:,:,np.newaxis]+background*(1-alpha[:,:,np.newaxis])
+    gaussA,gaussB,gaussM=[sprite],[background],[alpha]
+    for i in range(levels):
+        gaussA.append(cv2.pyrDown(gaussA[-1]))
+        gaussB.append(cv2.pyrDown(gaussB[-1]))
+        gaussM.append(cv2.pyrDown(gaussM[-1]))
+    result=gaussA[-1]*gaussM[-1][:,:,np.newaxis]+gaussB[-1]*(1-gaussM[-1][:,:,np.newaxis])
+    for i in range(levels-1,-1,-1):
+        size=(gaussA[i].shape[1],gaussA[i].shape[0])
+        lapA=gaussA[i]-cv2.pyrUp(gaussA[i+1],dstsize=size)
+        lapB=gaussB[i]-cv2.pyrUp(gaussB[i+1],dstsize=size)
+        m=gaussM[i][:,:,np.newaxis]
+        result=cv2.pyrUp(result,dstsize=size)+lapA*m+lapB*(1-m)
+    if out is None:
+        out=dst.copy()
+    out[y1:y2,x1:x2]=np.clip(result+0.5,0,255).astype('uint8')
+    return out
 def saveGif(imgList,outputPath,fps=4):
     import imageio
     frames=[cv2.cvtColor(img,cv2.COLOR_BGR2RGB) for img in imgList]
@@ -15,6 +15,9 @@ from paddleseg.transforms import transforms as T
 from paddleseg.cvlibs import manager, Config
 from PaddleSeg.contrib.CityscapesSOTA.models.mscale_ocrnet import *
 import time
+import threading
+from collections import OrderedDict
+import CVTools
 
 try:
 	from ConfigCityscapes import resultCode
@@ -37,12 +40,55 @@ def preProcess(im,transforms):
 	im = paddle.to_tensor(im)
 	return im,ori_shape
 
+## 最近分割过的图片的感知哈希索引，近似重复的图片(微信重新压缩,缩放)直接复用pred；裁剪过的图片宽高比不同，重新分割
+class predCacheClass():
+	def __init__(self,cacheSize=32,hammingThreshold=6,aspectTolerance=0.005):
+		self.cacheSize=cacheSize
+		self.hammingThreshold=hammingThreshold # max different bits of the 64 bits dHash
+		# pred is only resized, not moved: a rescaled copy keeps the aspect up to the rounding of its size,
+		# a crop changes it and the stretched pred would be off by several pixels at the borders
+		self.aspectTolerance=aspectTolerance
+		self.cache=OrderedDict()# hash -> (aspect,pred)
+		self.lock=threading.Lock()
+
+	def find(self,image):
+		imgHash=CVTools.dHash(image)
+		aspect=image.shape[1]/image.shape[0]
+		with self.lock:
+			bestHash,bestDistance=None,self.hammingThreshold+1
+			for key,(keyAspect,pred) in self.cache.items():
+				if abs(keyAspect-aspect)/aspect>self.aspectTolerance:
+					continue
+				distance=CVTools.hammingDistance(key,imgHash)
+				if distance<bestDistance:
+					bestHash,bestDistance=key,distance
+			if bestHash is None:
+				return imgHash,None
+			self.cache.move_to_end(bestHash)
+			pred=self.cache[bestHash][1]
+		print('pred cache hit, hamming distance',bestDistance)
+		if pred.shape[:2]!=image.shape[:2]:
+			# class index map, so no interpolation between classes
+			pred=cv2.resize(pred,(image.shape[1],image.shape[0]),interpolation=cv2.INTER_NEAREST)
+		else:
+			pred=pred.copy()
+		return imgHash,pred
+
+	def add(self,imgHash,image,pred):
+		with self.lock:
+			# the caller keeps using its pred
+			self.cache[imgHash]=(image.shape[1]/image.shape[0],pred.copy())
+			self.cache.move_to_end(imgHash)
+			while len(self.cache)>self.cacheSize:
+				self.cache.popitem(last=False)
+
 class cistyScaperClass():
 	def __init__(self,
 		debug=False,
 		cfgModelPath1='PetModel/mscale_ocr_cityscapes_autolabel_mapillary_ms_val.yml',
 		model_path1='PetModel/modelCityscape.pdparams',
-		
+		cacheSize=32,
+		hammingThreshold=6,
 	):
 		self.debug=debug
 		self.cfg = Config(cfgModelPath1)
@@ -55,11 +101,19 @@ class cistyScaperClass():
 		self.resultCode=resultCode
 		
 		self.classNums=19 #cityscape class nums
+		## cacheSize=0: do not reuse pred of near-duplicate images
+		self.predCache=predCacheClass(cacheSize,hammingThreshold) if cacheSize>0 else None
 
 	#return image size chrome pic,pixel value from 0 to 17(class 0~ class7)
-	def run(self,image):
+	## useCache=False: always run the model and leave the cache as it is, e.g. keyframes of a clip, whose
+	## near-duplicate earlier keyframe would bring back its stale pred
+	def run(self,image,useCache=True):
 		pred=[]
 		try:
+			if self.predCache is not None and useCache:
+				imgHash,cachedPred=self.predCache.find(image)
+				if cachedPred is not None:
+					return self.resultCode[4],cachedPred
 			t1=time.time()
 			im,ori_shape=preProcess(image,self.transforms)
 			print('seg time',time.time()-t1)
@@ -74,6 +128,8 @@ class cistyScaperClass():
 				pred = pred.numpy().astype('uint8')
 			
 			print('seg time',time.time()-t2)
+			if self.predCache is not None and useCache:
+				self.predCache.add(imgHash,image,pred)
 		except Exception as e:
 			print(e)
 			return self.resultCode[7],pred
@@ -14,6 +14,7 @@ resultCode=[{99:'运行报错'},
          {202: '没有人脸关键点'},
          ]
 ##
+## blendMode of the body: poisson(seamlessClone), pyramid or feather
 config={
     'alienHead':{
         1:{
@@ -35,6 +36,7 @@ config={
                 'lowestValue':10,
                 'heightGradientBias': 0.6,
                 'heightGradientBiasBody':0.95,#body gradient: where to start gradient
+                'blendMode': 'poisson',
                 'addWeightRatio':0.8
             },
             'side': {
@@ -52,6 +54,7 @@ config={
                 'lowestValue': 10,
                 'heightGradientBias': 0.6,
                 'heightGradientBiasBody':0.95,#body gradient: where to start gradient
+                'blendMode': 'poisson',
                 'addWeightRatio': 0.8
             }
 
@@ -76,6 +79,7 @@ config={
                 'lowestValue':10,#face gradient: lowest trancparece
                 'heightGradientBias': 0.6,#face gradient: where to start gradient
                 'heightGradientBiasBody':0.95,#body gradient: where to start gradient
+                'blendMode': 'poisson',
                 'addWeightRatio':0.8 #final combine ratio between seamlessclone and hard paste
             },
             'side':{
@@ -93,6 +97,7 @@ config={
                 'lowestValue':10,#face gradient: lowest trancparece
                 'heightGradientBias': 0.6,#face gradient: where to start gradient
                 'heightGradientBiasBody':0.95,#body gradient: where to start gradient
+                'blendMode': 'poisson',
                 'addWeightRatio':0.8 #final combine ratio between seamlessclone and hard paste
             }
 
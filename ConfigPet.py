@@ -18,6 +18,7 @@ resultCode=[{99:'运行报错'},
          {105:'module前处理异常'},
          ]
 ##
+## blendMode: poisson(seamlessClone), pyramid or feather
 config={
     'alien':{
         1:{
@@ -27,6 +28,7 @@ config={
             'picPath': '7im.jpg',
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
             'mask':0,
+            'blendMode': 'poisson',
             'mixTimes': 0
         },
         2:{
@@ -36,6 +38,7 @@ config={
             'picPath': 'lantian.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 1
         },       
         3:{
@@ -45,6 +48,7 @@ config={
             'picPath': 'feidie1.jpg',
             'mask':1,
             'scaleRatio': 0.11,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 0
         },  
         4:{
@@ -54,6 +58,7 @@ config={
             'picPath': 'xiaofeidie.jpg',
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
             'mask':0,
+            'blendMode': 'poisson',
             'mixTimes': 1
         },
         5:{
@@ -63,6 +68,7 @@ config={
             'picPath': 'lv.jpg',
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
             'mask':0,
+            'blendMode': 'poisson',
             'mixTimes': 0
         },
         6:{
@@ -72,6 +78,7 @@ config={
             'picPath': 'lan.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 1
         },       
         7:{
@@ -81,6 +88,7 @@ config={
             'picPath': 'huang.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 0
         },
         8:{
@@ -90,6 +98,7 @@ config={
             'picPath': 'cai.jpg',
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
             'mask':0,
+            'blendMode': 'poisson',
             'mixTimes': 0
         },
         9:{
@@ -99,6 +108,7 @@ config={
             'picPath': 'sanyan.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 0
         },       
         10:{
@@ -108,6 +118,7 @@ config={
             'picPath': 'tou.jpg',
             'mask':0,
             'scaleRatio': 0.4,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 0
         },        
         11:{
@@ -117,6 +128,7 @@ config={
             'picPath': '8im.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 1
         },          
         12:{
@@ -126,6 +138,7 @@ config={
             'picPath': '6im.jpg',
             'mask':0,
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 1
         },          
         13:{
@@ -135,6 +148,7 @@ config={
             'picPath': 'feidie2.jpg',
             'mask':1,
             'scaleRatio': 0.2,#from 0 ~1,ratio of the short border of pic
+            'blendMode': 'poisson',
             'mixTimes': 1
         },  
         14:{
@@ -144,6 +158,7 @@ config={
             'picPath': '3im.jpg',
             'scaleRatio': 0.18,#from 0 ~1,ratio of the short border of pic
             'mask':0,
+            'blendMode': 'poisson',
             'mixTimes': 1
         },     
     },
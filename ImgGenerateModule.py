@@ -7,6 +7,8 @@ except Exception as e:
 
     print(e)
 import os
+import random
+import threading
 import numpy as np
 import cv2
 try:
@@ -17,15 +19,14 @@ from alienPetModule import alienPetClass
 
 from vegetateModule import vegetateTransClass
 from sandModule import sandClass
+from feasibilityModule import feasibilityClass
+from runtimeTools import stageTimer
+import CVTools
 import paddle
 
 paddle.disable_static()
 # paddle.device.set_device("cpu")
-def minimizeInput(img,size):
-
-    ratio=size/max(img.shape[:2])
-    img=cv2.resize(img,None,fx=ratio,fy=ratio)
-    return img
+minimizeInput=CVTools.minimizeInput
 class ImgGenerator():
     def __init__(self, debug=False,
                  ymlPathSeg='PetModel/mscale_ocr_cityscapes_autolabel_mapillary_ms_val.yml',
@@ -34,12 +35,22 @@ class ImgGenerator():
                  picPathHead='HeadPic/',
                  picPathPet='PetPic/',
                  picPathVeg='VegPic',
+                 inferModelPathSand='msgnetInfer/msgnet',
                  inputSize=700,
-                 picSizeLimit=500):
+                 picSizeLimit=500,
+                 preCheck=True,
+                 loadThreshold=2,
+                 loadBlendMode=None):
         ##ps: pay attention to the pretrained model path in yml file
         self.resultCode = resultCode
         self.inputSize=inputSize
         self.picSizeLimit = picSizeLimit
+        ## more than loadThreshold requests in process: pets and alien bodies use loadBlendMode instead of their config
+        ## None(default): always the blendMode of ConfigPet/ConfigHead, the output does not change with the load
+        self.loadThreshold = loadThreshold
+        self.loadBlendMode = loadBlendMode
+        self.inflight = 0
+        self.loadLock = threading.Lock()
         ## 环境识别
         try:
             self.seg = cistyScaperClass(
@@ -68,13 +79,16 @@ class ImgGenerator():
         try:
             self.vegetation = vegetateTransClass(picPath=picPathVeg)
             print('self.vegetation sucess:',self.vegetation)
-            self.sander = sandClass(stylePath=os.path.join(picPathVeg,'sand.jpg'),modelPath=modelPathSand)
+            self.sander = sandClass(stylePath=os.path.join(picPathVeg,'sand.jpg'),modelPath=modelPathSand,inferModelPath=inferModelPathSand)
             
             print('self.sander sucess:',self.sander)
         except Exception as e:
             print(e)
 
 
+        ## 分割前的快速预判，避免对不可能满足的请求跑分割
+        self.feasibility = feasibilityClass(debug=debug) if preCheck else None
+
         # print('ImgGenerator resultCode', resultCode)
         # 换外星动物
         try:
@@ -82,59 +96,125 @@ class ImgGenerator():
         except Exception as e:
             print(' pet  module error:', e)
 
-    def process(self, dst, alienHeadIndex,  vegetateIndex,enviromentIndex,alienPetIndex):
-        img = []
-        dic = []
+    def blendModeUnderLoad(self):
+        # None: use the blendMode of ConfigPet/ConfigHead
+        with self.loadLock:
+            if self.loadBlendMode is not None and self.inflight > self.loadThreshold:
+                print('under load, inflight', self.inflight, 'blend mode', self.loadBlendMode)
+                return self.loadBlendMode
+        return None
+
+    def enterLoad(self, step):
+        with self.loadLock:
+            self.inflight += step
+
+    def process(self, dst, alienHeadIndex,  vegetateIndex,enviromentIndex,alienPetIndex,alienPetCount=1,allFaces=False):
+        blendMode = self.blendModeUnderLoad()
+        analysis = self.analyze(dst, alienHeadIndex, vegetateIndex, enviromentIndex, alienPetIndex, allFaces)
+        rcAll, img, dic = self.compose(analysis, alienHeadIndex, vegetateIndex, enviromentIndex, alienPetIndex,
+                                       alienPetCount, allFaces, blendMode)
+        print('imgGenerate process finish')
+        return rcAll, img, dic
 
+    def analyze(self, dst, alienHeadIndex, vegetateIndex, enviromentIndex, alienPetIndex, allFaces=False):
+        # 推理部分：预判、分割、人脸关键点。返回给compose的dict，'img'不为None时已经是最终结果
+        analysis = {'rc': None, 'img': None, 'dst': dst, 'pred': [], 'vegFeasible': True, 'petCandidates': None, 'faces': None}
         if dst is None:
-            rcAll = self.resultCode[1]
+            analysis['rc'], analysis['img'] = self.resultCode[1], []
             print('dst img is none')
+            return analysis
+        print('dst image shape', dst.shape[:2])
+        if np.max(dst.shape[:2]) < self.picSizeLimit:
+            ##pic too small
+            analysis['rc'], analysis['img'] = self.resultCode[2], []
+            return analysis
+        if not (alienHeadIndex >= 0 or alienPetIndex >= 0 or enviromentIndex >= 0 or vegetateIndex >= 0):
+            ##
+            print('do not ask for generate')
+            analysis['rc'], analysis['img'] = self.resultCode[4], dst
+            return analysis
+        dst = minimizeInput(dst,self.inputSize)
+        analysis['dst'] = dst
+        ## precheck on a thumbnail, segmentation only runs when some stage may use it
+        with stageTimer('precheck'):
+            absentAreas = self.feasibility.run(dst) if self.feasibility is not None else set()
+            vegFeasible = self.vegetateFeasible(vegetateIndex, absentAreas)
+            petCandidates = self.alienPetCandidates(alienPetIndex, absentAreas)
+        analysis['vegFeasible'], analysis['petCandidates'] = vegFeasible, petCandidates
+        if (vegetateIndex >= 0 and vegFeasible) or enviromentIndex >= 0 or \
+                (petCandidates is not None and len(petCandidates) > 0):
+            with stageTimer('seg'):
+                rcSeg, pred = self.seg.run(dst)
         else:
-
-
-            print('dst image shape', dst.shape[:2])
-            if np.max(dst.shape[:2]) < self.picSizeLimit:
-                ##pic too small
-                rcAll = self.resultCode[2]
-            else:
-                if alienHeadIndex >= 0 or alienPetIndex >= 0 or enviromentIndex >= 0 or vegetateIndex >= 0:
-                    dst = minimizeInput(dst,self.inputSize)
-                    rcSeg, pred = self.seg.run(dst)
-                    if list(rcSeg.keys())[0] < 200:
-                        rcAll = self.resultCode[6]
-                    else:
-                        ## the total result code of whole process
-                        rcAll = rcSeg
-                        rcHead, img, dicHead = self.alienHeadProcess(alienHeadIndex, dst)
-                        ##
-                        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcHead)
-                        rcVeg, img, dicVeg = self.vegetateProcess(vegetateIndex, img, pred)
-
-                        ##
-                        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcVeg)
-                        #print(rcAll,rcPet)
-                        rcEnv, img, dicEnv = self.enviromentProcess(enviromentIndex, img, pred)
-                        ##
-                        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcEnv)
-                        rcPet, img, dicPet = self.alienPetProcess(alienPetIndex, img, pred, self.seg.classNums)
-
-                        ##
-                        dic = [dicHead, dicVeg, dicEnv,dicPet]
-                else:
-                    ##
-                    print('do not ask for generate')
-                    rcAll = self.resultCode[4]
-                    img = dst
-        print('imgGenerate process finish')
-        return rcAll, img, dic
-
-    def alienPetProcess(self, alienPetIndex, img,pred,classNums):
+            print('precheck: no stage needs segmentation')
+            rcSeg, pred = self.resultCode[4], []
+        if list(rcSeg.keys())[0] < 200:
+            analysis['rc'], analysis['img'] = self.resultCode[6], []
+            return analysis
+        ## the total result code of whole process
+        analysis['rc'], analysis['pred'] = rcSeg, pred
+        transHead = getattr(self, 'transHead', None)
+        if transHead is not None and 0 <= alienHeadIndex <= len(transHead.charterDict) and len(dst) >= 3:
+            with stageTimer('landmark'):
+                try:
+                    analysis['faces'] = transHead.detectFaces(dst, allFaces)
+                except Exception as e:
+                    # detected again in compose, where the head module reports the error
+                    print('landmark error:', e)
+        return analysis
+
+    def compose(self, analysis, alienHeadIndex, vegetateIndex, enviromentIndex, alienPetIndex, alienPetCount=1,
+                allFaces=False, blendMode=None):
+        # 合成部分：换头、植物、建筑、外星生物。return rc, img, [dicHead, dicVeg, dicEnv, dicPet]
+        if analysis['img'] is not None:
+            return analysis['rc'], analysis['img'], []
+        rcAll, dst, pred = analysis['rc'], analysis['dst'], analysis['pred']
+        with stageTimer('head'):
+            rcHead, img, dicHead = self.alienHeadProcess(alienHeadIndex, dst, blendMode, allFaces, analysis['faces'])
+        ##
+        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcHead)
+        with stageTimer('vegetate'):
+            rcVeg, img, dicVeg = self.vegetateProcess(vegetateIndex, img, pred, analysis['vegFeasible'])
+
+        ##
+        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcVeg)
+        #print(rcAll,rcPet)
+        with stageTimer('environment'):
+            rcEnv, img, dicEnv = self.enviromentProcess(enviromentIndex, img, pred)
+        ##
+        img, dst, rcAll = self.checkLastResult(img, dst, rcAll, rcEnv)
+        with stageTimer('pet'):
+            rcPet, img, dicPet = self.alienPetProcess(alienPetIndex, img, pred, self.seg.classNums,
+                                                      analysis['petCandidates'], blendMode, alienPetCount)
+
+        ##
+        return rcAll, img, [dicHead, dicVeg, dicEnv,dicPet]
+
+    def alienPetCandidates(self, alienPetIndex, absentAreas):
+        # None: pet not asked or index out of range, []: no alien can appear in the picture
+        if alienPetIndex < 0 or alienPetIndex > len(self.petModule.alienDict):
+            return None
+        return self.petModule.precheck(absentAreas, alienPetIndex)
+
+    def vegetateFeasible(self, index, absentAreas):
+        if index < 0 or self.vegetation is None:
+            return True
+        return self.vegetation.precheck(absentAreas)
+
+    def alienPetProcess(self, alienPetIndex, img,pred,classNums,candidates=None,blendMode=None,count=1):
+        # count>1: place up to count aliens in one pass, dic is the list of the placed aliens
         dic = {}
         if alienPetIndex >= 0:
             print(alienPetIndex, len(self.petModule.alienDict))
             if alienPetIndex <= len(self.petModule.alienDict):
+                if candidates is not None and len(candidates) == 0:
+                    print('precheck: no area for alien pet', alienPetIndex)
+                    return self.resultCode[8], img, dic
                 print('begin alien pet module', alienPetIndex)
-                rc, img, dic = self.petModule.run(img, pred,classNums,alienPetIndex)
+                if count > 1:
+                    rc, img, dic = self.petModule.runMulti(img, pred, classNums, count, alienPetIndex, candidates, blendMode)
+                else:
+                    rc, img, dic = self.petModule.run(img, pred,classNums,alienPetIndex,candidates,blendMode)
             else:
                 rc = self.resultCode[5]
         else:
@@ -151,13 +231,14 @@ class ImgGenerator():
             print('ImgGenerator:last process not sucess')
             return dst, dst, rc
     # 
-    def alienHeadProcess(self, alienHeadIndex, dst):
+    def alienHeadProcess(self, alienHeadIndex, dst, blendMode=None, allFaces=False, faces=None):
+        # allFaces: every face of a group photo becomes the alien, faces: landmarks from analyze
         img = dst
         dic = {}
         if alienHeadIndex >= 0:
             if alienHeadIndex <= len(self.transHead.charterDict):
                 print('begin trans head module')
-                rc, img, dic = self.transHead.run(dst, alienHeadIndex)
+                rc, img, dic = self.transHead.run(dst, alienHeadIndex, blendMode, allFaces, faces)
             else:
                 rc = self.resultCode[5]
         else:
@@ -166,13 +247,16 @@ class ImgGenerator():
 
         return rc, img, dic
 
-    def vegetateProcess(self, index, dst, pred):
+    def vegetateProcess(self, index, dst, pred, feasible=True):
         img = dst
         dic = {}
         if index >= 0:
 
             if self.vegetation is None: return self.resultCode[4],img, dic
             if index <= len(self.vegetation.configDict):
+                if not feasible:
+                    print('precheck: no area match vegetate')
+                    return self.vegetation.resultCode[6], img, dic
                 print('begin veg  module')
                 rc, img, dic = self.vegetation.run(dst, index, pred)
             else:
@@ -196,25 +280,159 @@ class ImgGenerator():
 
         return rc, img, dic
 
-    def run(self, dstPath, alienHeadIndex=-1,vegetateIndex=-1, environmentIndex=-1,alienPetIndex=-1):
+    def run(self, dstPath, alienHeadIndex=-1,vegetateIndex=-1, environmentIndex=-1,alienPetIndex=-1,alienPetCount=1,allFaces=False):
+        self.enterLoad(1)
         try:
             print('dstPath path:', dstPath)
             dst = cv2.imread(dstPath)
-            return self.process(dst, alienHeadIndex,  vegetateIndex,alienPetIndex, environmentIndex)
+            return self.process(dst, alienHeadIndex,  vegetateIndex,alienPetIndex, environmentIndex, alienPetCount, allFaces)
         except Exception as e:
             print(e)
             print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
             print('行号', e.__traceback__.tb_lineno)
             return self.resultCode[0], [], []
-    def runImg(self, dst, alienHeadIndex=-1,vegetateIndex=-1, environmentIndex=-1,alienPetIndex=-1):
+        finally:
+            self.enterLoad(-1)
+    def runImg(self, dst, alienHeadIndex=-1,vegetateIndex=-1, environmentIndex=-1,alienPetIndex=-1,alienPetCount=1,allFaces=False):
+        self.enterLoad(1)
         try:
 
-            return self.process(dst, alienHeadIndex,  vegetateIndex, environmentIndex,alienPetIndex)
+            return self.process(dst, alienHeadIndex,  vegetateIndex, environmentIndex,alienPetIndex,alienPetCount,allFaces)
+        except Exception as e:
+            print(e)
+            print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
+            print('行号', e.__traceback__.tb_lineno)
+            return self.resultCode[0], [], []
+        finally:
+            self.enterLoad(-1)
+
+    def processFrames(self, frames, vegetateIndex=-1, enviromentIndex=-1, alienPetIndex=-1, keyInterval=8, blendMode=None):
+        # 短视频/帧序列：只有每keyInterval帧的关键帧做分割，中间帧的分割结果由光流传播
+        # 外星pet只在第一帧选择位置，之后跟着所在区域的光流移动；换头不支持
+        # return rc, list of frames, [{}, dicVeg, dicEnv, dicPet]
+        if int(keyInterval) < 1:
+            raise ValueError('keyInterval must be >= 1, got %s' % keyInterval)
+        keyInterval = int(keyInterval)
+        if len(frames) == 0 or frames[0] is None:
+            return self.resultCode[1], [], []
+        if np.max(frames[0].shape[:2]) < self.picSizeLimit:
+            return self.resultCode[2], [], []
+        ## the same vegetation and flip for all frames
+        if vegetateIndex == 0 and self.vegetation is not None:
+            vegetateIndex = random.randint(1, len(self.vegetation.configDict))
+        vegFlip = random.randint(0, 1) == 1
+        results = []
+        dicVeg, dicEnv, dicPet = {}, {}, {}
+        rcAll = self.resultCode[4]
+        pred = None
+        prevGray = None
+        placement = None
+        offset = np.zeros(2)# moving of the pet since the first frame, [dx,dy]
+        for index, frame in enumerate(frames):
+            frame = minimizeInput(frame, self.inputSize)
+            gray = CVTools.flowGray(frame)
+            flow = None
+            if prevGray is not None:
+                with stageTimer('flow'):
+                    flow = CVTools.backFlow(prevGray, gray, frame.shape)
+            if index % keyInterval == 0:
+                with stageTimer('seg'):
+                    # the keyframe refreshes the propagated mask, a cached pred of an earlier keyframe would not
+                    rcSeg, pred = self.seg.run(frame, useCache=False)
+                if list(rcSeg.keys())[0] < 200:
+                    return self.resultCode[6], [], []
+            else:
+                pred = CVTools.propagateMask(pred, flow)
+            prevGray = gray
+            img = frame
+            if vegetateIndex >= 0 and self.vegetation is not None:
+                with stageTimer('vegetate'):
+                    rc, img, dic = self.vegetation.run(img, vegetateIndex, pred, flip=vegFlip)
+                if list(rc.keys())[0] >= 200:
+                    dicVeg = dic
+            if enviromentIndex >= 0:
+                with stageTimer('environment'):
+                    rc, imgEnv, dic = self.enviromentProcess(enviromentIndex, img, pred)
+                if list(rc.keys())[0] >= 200:
+                    img, dicEnv = imgEnv, dic
+            if alienPetIndex >= 0:
+                with stageTimer('pet'):
+                    if index == 0:
+                        placement, dicPet = self.planFramePet(alienPetIndex, img, pred, blendMode)
+                    elif placement is not None:
+                        offset = self.followFramePet(placement, offset, flow)
+                    img = self.blendFramePet(img, pred, placement, offset)
+            results.append(img)
+        if alienPetIndex >= 0 and placement is None:
+            rcAll = self.resultCode[8]
+        print('process frames finish', len(results), 'segmentations', (len(frames) + keyInterval - 1) // keyInterval)
+        return rcAll, results, [{}, dicVeg, dicEnv, dicPet]
+
+    def planFramePet(self, alienPetIndex, img, pred, blendMode=None):
+        # placement of the pet on the first frame, (None, {}) if no area for it
+        if alienPetIndex > len(self.petModule.alienDict):
+            return None, {}
+        classOkArea = self.petModule.checkClassArea(pred, self.seg.classNums)
+        alienIndex, areaIndex = self.petModule.chooseCheckAlien(alienPetIndex, classOkArea)
+        if alienIndex <= 0:
+            return None, {}
+        placement = self.petModule.plan(img, pred, alienIndex, areaIndex, blendMode)
+        if placement is None:
+            return None, {}
+        return placement, self.petModule.alienDict[alienIndex]
+
+    def followFramePet(self, placement, offset, flow):
+        # the pet moves with the scene under it, median flow of its box. return the new offset
+        x1, y1 = np.maximum(np.array(placement['leftTop']) + np.round(offset).astype('int32'), 0)
+        x2, y2 = np.array(placement['rightdown']) + np.round(offset).astype('int32')
+        motion = flow[y1:max(y2, y1 + 1), x1:max(x2, x1 + 1)].reshape(-1, 2)
+        if len(motion) > 0:
+            offset = offset - np.median(motion, axis=0)
+        return offset
+
+    def blendFramePet(self, img, pred, placement, offset):
+        # blend the pet moved by offset into the frame, roi only
+        if placement is None:
+            return img
+        moved = self.petModule.moved(placement, offset, img)
+        if moved is None:
+            return img
+        try:
+            return self.petModule.blend(img.copy(), img, pred, moved)
+        except Exception as e:
+            print('frame pet blend error:', e)
+            return img
+
+    def runFrames(self, frames, vegetateIndex=-1, environmentIndex=-1, alienPetIndex=-1, keyInterval=8):
+        self.enterLoad(1)
+        try:
+            return self.processFrames(frames, vegetateIndex, environmentIndex, alienPetIndex, keyInterval,
+                                      self.blendModeUnderLoad())
+        except Exception as e:
+            print(e)
+            print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
+            print('行号', e.__traceback__.tb_lineno)
+            return self.resultCode[0], [], []
+        finally:
+            self.enterLoad(-1)
+
+    def runClip(self, clipPath, vegetateIndex=-1, environmentIndex=-1, alienPetIndex=-1, keyInterval=8, maxFrames=75):
+        # clip file(or any source of cv2.VideoCapture), at most maxFrames frames
+        try:
+            capture = cv2.VideoCapture(clipPath)
+            frames = []
+            while len(frames) < maxFrames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                frames.append(frame)
+            capture.release()
         except Exception as e:
             print(e)
             print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
             print('行号', e.__traceback__.tb_lineno)
             return self.resultCode[0], [], []
+        return self.runFrames(frames, vegetateIndex, environmentIndex, alienPetIndex, keyInterval)
 
 imgGenerator = ImgGenerator(debug=False,
                    ymlPathSeg='PetModel/mscale_ocr_cityscapes_autolabel_mapillary_ms_val.yml',
@@ -222,7 +440,10 @@ imgGenerator = ImgGenerator(debug=False,
                    modelPathSand='msgnet',
                    picPathHead='HeadPic/',
                    picPathPet='PetPic/',
-                   picPathVeg='VegPic')
+                   picPathVeg='VegPic',
+                   # IMG_LOAD_BLEND_MODE=pyramid/feather: the faster blend above IMG_LOAD_THRESHOLD requests in process
+                   loadThreshold=int(os.getenv('IMG_LOAD_THRESHOLD', '2')),
+                   loadBlendMode=os.getenv('IMG_LOAD_BLEND_MODE') or None)
 
 
 if __name__ == '__main__':
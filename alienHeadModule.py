@@ -10,7 +10,7 @@ import os
 import CVTools
 from ConfigHead import config,resultCode
 class TransHeadClass():
-    def __init__(self,debug=False,sideAngleThreshold=12,picPath='HeadPic/',config=config):
+    def __init__(self,debug=False,sideAngleThreshold=12,picPath='HeadPic/',config=config,spriteLevels=4):
         self.debug=debug
         self.sideAngleThreshold=sideAngleThreshold
         self.fl=landmarker(self.debug)
@@ -21,12 +21,35 @@ class TransHeadClass():
         self.picSizeLimit=500
         self.resultCode=resultCode
         #print('charterDict',self.charterDict)
-    def run(self,dst,charterIndex):
+        self.bank=self.buildBank(spriteLevels)
+
+    def buildBank(self,levels=4):
+        # 加载时预处理每个外星人front/side的body与head：几个尺度的pyramid(含左右翻转)，及landmark
+        # 请求时只需取最近的较大尺度，再缩放一次到目标大小
+        bank={}
+        pyramids={}# front and side may share the same picture
+        for charterIndex,charter in self.charterDict.items():
+            for face in ['front','side']:
+                cfg=charter[face]
+                key=(cfg['bodyPath'],cfg['headLower'],cfg['NeckHeight'])
+                if key not in pyramids:
+                    srcBody=cv2.imread(os.path.join(self.picPath,cfg['bodyPath']),cv2.IMREAD_UNCHANGED )
+                    assert  len(srcBody.shape)>2
+                    srcBody,srcHead= CVTools.roiHeadBody(srcBody,cfg['headLower'],cfg['NeckHeight'])
+                    pyramids[key]=(CVTools.spritePyramid(srcBody,levels),CVTools.spritePyramid(srcHead,levels))
+                bank[(charterIndex,face)]={
+                    'srcLM':readJson(os.path.join(self.picPath,cfg['LMJson'])),# [[x,y],,,]
+                    'body':pyramids[key][0],
+                    'head':pyramids[key][1]}
+        print('alien head sprite bank',len(bank))
+        return bank
+    def run(self,dst,charterIndex,blendMode=None,allFaces=False,faces=None):
+        # faces: landmarks from detectFaces when the detection already ran(e.g. in the analyze stage of a pipeline)
         charterIndex=int(charterIndex)
         if charterIndex>len(self.charterDict):
             return self.resultCode[5],[], {}
         try:
-            return self.process(dst, charterIndex)
+            return self.process(dst, charterIndex, blendMode, allFaces, faces)
         except Exception as e:
             print('tran headmodule error:',e)
             print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
@@ -34,7 +57,15 @@ class TransHeadClass():
 
             return self.resultCode[0],dst, {}
         
-    def process(self,dst,charterIndex):
+    def detectFaces(self,dst,allFaces=False):
+        # landmarks of the faces to paste: all faces, the tallest first, or only the tallest one
+        if allFaces:
+            return sorted([np.array(la) for la in self.fl.run(dst,allFaces=True)],key=lambda la:-(np.max(la[:,1])-np.min(la[:,1])))
+        dstLM,dstHeight=self.fl.heightestFace(dst)
+        return [dstLM] if len(dstLM)>0 else []
+
+    def process(self,dst,charterIndex,blendMode=None,allFaces=False,faces=None):
+        # allFaces: every face of the picture becomes the alien, else only the tallest one
         charterIndex=int(charterIndex)
         if len(dst)<3:
             # resultCode=101
@@ -48,14 +79,65 @@ class TransHeadClass():
         print('dst shape',dst.shape,'charter:',charter,'charterIndex',charterIndex)
 
 
-        dstOri=dst.copy()
-        dstLM,dstHeight=self.fl.heightestFace(dst)
+        if faces is None:
+            faces=self.detectFaces(dst,allFaces)
         ## AREA have face
-        if len(dstLM)==0:
+        if len(faces)==0:
             print('没有找到人脸关键点')
 
             return self.resultCode[6],dst, {}
+        return self.processLandmarks(dst,faces,charterIndex,blendMode)
+
+    def processLandmarks(self,dst,faces,charterIndex,blendMode=None):
+        # faces: landmarks already known(e.g. tracked by a streaming session), no detection here
+        if charterIndex==0:
+            charterIndex=random.randint(1,len(self.charterDict))
+        ## heads are hard pasted to dstOri, bodies are blended to normalClone, maskDst is the mask of all heads
+        dstOri=dst.copy()
+        normalClone=dst.copy()
+        maskDst=np.zeros(dstOri.shape,dstOri.dtype)
+        addWeightRatio=None
+        for dstLM in faces:
+            # group photo: a face which fails(e.g. landmarks at the border) is skipped, the others are still pasted
+            backup=[dstOri.copy(),normalClone.copy(),maskDst.copy()] if len(faces)>1 else None
+            try:
+                ratio=self.pasteFace(dst,dstLM,charterIndex,dstOri,normalClone,maskDst,blendMode)
+            except Exception as e:
+                if backup is None:
+                    raise
+                print('face skipped:',e)
+                # pasteFace works in place, undo the part of the face already pasted
+                dstOri[...],normalClone[...],maskDst[...]=backup
+                continue
+            # addWeightU8 mixes dstOri and normalClone once, under the mask of all heads, so there is one ratio
+            # for the picture: the one of the first pasted face, the tallest(detectFaces sorts them)
+            if addWeightRatio is None:
+                addWeightRatio=ratio
+        if addWeightRatio is None:
+            print('人脸角度太偏了')
+
+            return self.resultCode[3],dst, {}
 
+        result=CVTools.addWeightU8(dstOri, normalClone, addWeightRatio, maskDst)
+        # result = addWeight(dstOri, normal_clone, addWeightRatio, None)
+        if self.debug:
+            cv2.imwrite('test/normal_clone0.jpg', normalClone)
+            cv2.imwrite('test/result.jpg',result)
+            cv2.imwrite('hardPaste.jpg',dstOri)
+            cv2.imwrite('maskDst.jpg',maskDst)
+
+        # ##
+        # dstFace,center,mask3=CVTools.roiDst(dst,dstLM)
+        # # print(dstFace.type(),center.type(),mask3.type(),result.type())
+        #
+        # result = cv2.seamlessClone(dstFace, normal_clone, mask3, center, cv2.MONOCHROME_TRANSFER)
+        # cv2.imwrite('im.jpg',mask3)
+
+        return self.resultCode[4],result,self.charterDict[charterIndex]
+
+    def pasteFace(self,dst,dstLM,charterIndex,dstOri,normalClone,maskDst,blendMode=None):
+        # 一张人脸换成外星人：head硬贴到dstOri，body融合到normalClone(都是in place)，head的渐变mask累加到maskDst
+        # return the addWeightRatio of the face, None: face turned too far to the side, not pasted
         headAngleBias=CVTools.headAngle(dstLM)
         print('headAngleBias',headAngleBias)
         if np.abs(headAngleBias[0])<self.sideAngleThreshold:
@@ -66,7 +148,7 @@ class TransHeadClass():
             # face = 'side'
             print('人脸角度太偏了')
 
-            return self.resultCode[3],dst, {}
+            return None
 
 
         scaleRatio=self.charterDict[charterIndex][face]['scaleRatio']
@@ -74,35 +156,31 @@ class TransHeadClass():
         ratioY=self.charterDict[charterIndex][face]['ratioY']
         preBias = self.charterDict[charterIndex][face]['preBias']#[x ratio of face,y ratio of face]bias after align at the eyes
 
-        srcPath2=self.charterDict[charterIndex][face]['bodyPath']
-        srcLM = readJson(os.path.join(self.picPath,self.charterDict[charterIndex][face]['LMJson']) )# [[x,y],,,]
+        sprites=self.bank[(charterIndex,face)]
+        srcLM = sprites['srcLM']# [[x,y],,,]
 
-        neckHeight=self.charterDict[charterIndex][face]['NeckHeight']
         lowestValue = self.charterDict[charterIndex][face]['lowestValue']
         heightGradientBias = self.charterDict[charterIndex][face]['heightGradientBias']
         heightGradientBiasBody = self.charterDict[charterIndex][face]['heightGradientBiasBody']
 
         addWeightRatio=self.charterDict[charterIndex][face]['addWeightRatio']
 
-        headLower=self.charterDict[charterIndex][face]['headLower']
+        # body blend: poisson/pyramid/feather, blendMode from the caller(e.g. under load) overrides the config
+        if blendMode is None:
+            blendMode=self.charterDict[charterIndex][face].get('blendMode','poisson')
         # description=self.charterDict[charterIndex]['description']
     # print('srcLM', srcLM)
     ##
-        # print('srcPath2',srcPath2)
-        # srcPath2=''
-        srcBody=cv2.imread(os.path.join(self.picPath,srcPath2),cv2.IMREAD_UNCHANGED )
-        assert  len(srcBody.shape)>2
-        # print('srcBody',srcBody.shape)
         #
         targetCenter,targetScaleX = CVTools.landmarkCenter(dstLM)
         srcCenter,srcScaleX =  CVTools.landmarkCenter(srcLM)
         ratio=targetScaleX/srcScaleX*scaleRatio
 
     #
-        srcBody,srcHead= CVTools.roiHeadBody(srcBody,headLower,neckHeight)
-
-        srcBody=CVTools.resize(srcBody,ratioX,ratioY,ratio)
-        srcHead=CVTools.resize(srcHead,ratioX,ratioY,ratio)
+        ## face to left-hand side: the flipped sprites
+        flip=bool(headAngleBias[0]>self.sideAngleThreshold)
+        srcBody=CVTools.resizeFromPyramid(sprites['body'],ratioX,ratioY,ratio,flip)
+        srcHead=CVTools.resizeFromPyramid(sprites['head'],ratioX,ratioY,ratio,flip)
     #
         srcLMHead = srcLM.copy()
         # srcLMHead[:, 0] = srcLMHead[:, 0] - headLeft
@@ -110,7 +188,9 @@ class TransHeadClass():
         srcLMHead = np.array(srcLMHead * ratio, 'int64')
         srcLM = np.array(srcLM * ratio, 'int64')
         #
-        srcLM, srcBody, srcLMHead, srcHead=CVTools.flipFace(headAngleBias, self.sideAngleThreshold, srcLM, srcBody, srcLMHead, srcHead)
+        if flip:
+            srcLM[:,0]=srcBody.shape[1]-srcLM[:,0]
+            srcLMHead[:,0]=srcHead.shape[1]-srcLMHead[:,0]
 
         maskBody,srcBody=CVTools.splitMask(srcBody)
         maskHead,srcHead=CVTools.splitMask(srcHead)
@@ -126,20 +206,18 @@ class TransHeadClass():
 
         ##mask of the head(just head) with 3 channel
         maskHead3 = CVTools.mask3Channel(maskHead,srcHead)
-        ##mask of the whole dst picture
-        maskDst=np.zeros(dstOri.shape,dstOri.dtype)
 
-        dstOri=CVTools.hardPaste(dstOri,leftTop,rightDown,maskHead3,srcHead)
+        CVTools.hardPaste(dstOri,leftTop,rightDown,maskHead3,srcHead)
 
         #gradient mask
         maskHead3=CVTools.gradientMask(maskHead3, lowestValue, heightGradientBias)
-        maskDst[leftTop[1]:rightDown[1],leftTop[0]:rightDown[0],:]=maskHead3
+        ## mask of the whole dst picture, heads of other faces may be there already
+        maskRoi=maskDst[leftTop[1]:rightDown[1],leftTop[0]:rightDown[0],:]
+        np.maximum(maskRoi,maskHead3,out=maskRoi)
 
         if self.debug:
             cv2.imwrite('maskHead3.jpg',maskHead3)
             cv2.imwrite('srcBody.jpg',srcBody)
-            cv2.imwrite('hardPaste.jpg',dstOri)
-            cv2.imwrite('maskDst.jpg',maskDst)
         # ##
 
         leftTop=CVTools.calLandmarkLeftTop(dstLM, srcLM,preBias,headAngleBias)
@@ -155,23 +233,11 @@ class TransHeadClass():
         # print('leftTop,rightDown',leftTop,rightDown,center)
 
         # maskBody3=cv2.cvtColor(srcBody,cv2.COLOR_BGR2GRAY)
-        normal_clone = cv2.seamlessClone(srcBody, dst, maskBody3, center, cv2.NORMAL_CLONE)
+        CVTools.blendClone(srcBody, normalClone, maskBody3, center, cv2.NORMAL_CLONE, blendMode, out=normalClone)
         # normal_clone =hardPaste(dst,leftTop,rightDown,maskBody3,srcBody)
-        result=CVTools.addWeight(dstOri, normal_clone, addWeightRatio, maskDst)
-        # result = addWeight(dstOri, normal_clone, addWeightRatio, None)
         if self.debug:
-            cv2.imwrite('test/normal_clone0.jpg', normal_clone)
-            cv2.imwrite('test/result.jpg',result)
             cv2.imwrite('test/maskBody33.jpg',maskBody3)
-
-        # ##
-        # dstFace,center,mask3=CVTools.roiDst(dst,dstLM)
-        # # print(dstFace.type(),center.type(),mask3.type(),result.type())
-        #
-        # result = cv2.seamlessClone(dstFace, normal_clone, mask3, center, cv2.MONOCHROME_TRANSFER)
-        # cv2.imwrite('im.jpg',mask3)
-
-        return self.resultCode[4],result,self.charterDict[charterIndex]
+        return addWeightRatio
 if __name__=='__main__':
     dstPath='testpic/jiayuting.jpg'
     # dstPath='testpic/wyf.jpg'
@@ -6,6 +6,7 @@ import cv2
 import numpy as np
 import paddle
 import random
+import CVTools
 # from CityscapesModule import cistyScaperClass
 from ConfigPet import config as configAlienPet
 
@@ -37,23 +38,31 @@ class alienPetClass():
         self.resultCode=resultCode
         self.petPicPath=petPicPath
         self.areaThreshold=10000 # pixel of the area, area should be large enough, 
+        self.sprites={} # alienIndex -> (sprite, mask of white background) at native resolution
         # print('petPicPath:',petPicPath,'alienDict,',(self.alienDict))
     def checkClassArea(self, pred, classNums):
 
-    ##检查cityscape的分割结果是否可以满足某个 classID的外星生物出现
-        classArea = []
+    ##检查cityscape的分割结果是否可以满足某个 classID的外星生物出现
+        # 一次bincount得到每个类别的像素数
+        counts = np.bincount(np.asarray(pred, 'int64').ravel(), minlength=classNums)
         classOkArea = {}
         for index in range(classNums):
-            temp = np.argwhere(pred == index)
-            classArea.append(temp)
-            if len(temp) > self.areaThreshold:  ##  pixel number of area is large enough? 符合出现的区域要足够大
+            if counts[index] > self.areaThreshold:  ##  pixel number of area is large enough? 符合出现的区域要足够大
 
-                classOkArea[index] = temp
-         # 生成key为外星生物id，value为可该外星生物可出现的区域的dict
+                classOkArea[index] = int(counts[index])
+         # 生成key为区域id，value为该区域像素数的dict
         return classOkArea
 
 
-    def chooseCheckAlien(self,alienIndex,classOkArea):
+    def precheck(self,absentAreas,alienIndex):
+        # 分割前预判：去掉所在区域已被判断为不存在的外星生物，返回仍可能出现的alien index list
+        if alienIndex==0:
+            alienIndexList=list(self.alienDict.keys())
+        else:
+            alienIndexList=[alienIndex]
+        return [al for al in alienIndexList if self.alienDict[al]['areaIndex'] not in absentAreas]
+
+    def chooseCheckAlien(self,alienIndex,classOkArea,candidates=None):
         #根据alienIndex，及可出现的外星生物区域dict， 选择出现的外星生物
 
         #print(type(classOkArea),classOkArea.keys())
@@ -64,6 +73,9 @@ class alienPetClass():
         ## alienindex=0 则 random alien pet 
         if alienIndex==0:          
             alienIndexList=list(self.alienDict.keys())
+            ## only the aliens passed the precheck
+            if candidates is not None:
+                alienIndexList=list(candidates)
             random.shuffle(alienIndexList)
         ##specified index of alien pet   
         else:
@@ -77,87 +89,139 @@ class alienPetClass():
                 return al,areaIndex
         return -1,-1
 
-    def process(self,image,pred,classNums,alienIndex):
+    def alienPool(self,alienIndex,classOkArea,candidates=None):
+        # 多只pet：所有区域在图中的外星生物
+        if alienIndex==0:
+            alienIndexList=list(self.alienDict.keys()) if candidates is None else list(candidates)
+        else:
+            alienIndexList=[alienIndex]
+        return [al for al in alienIndexList if self.alienDict[al]['areaIndex'] in classOkArea]
+
+    def sprite(self,alienIndex):
+        # 外星pet图像及其白底mask只读取、计算一次，按原始分辨率缓存
+        if alienIndex not in self.sprites:
+            print('read pic:',os.path.join(self.petPicPath,self.alienDict[alienIndex]['picPath']))
+            src=cv2.imread(os.path.join(self.petPicPath,self.alienDict[alienIndex]['picPath']))
+            assert len(src.shape)>2
+            self.sprites[alienIndex]=(src,maskOfWhiteBG(src,threshold=240))
+        return self.sprites[alienIndex]
+
+    def plan(self,image,pred,alienIndex,areaIndex,blendMode=None,occupancy=None):
+        # 读取外星pet图像，缩放并找到位置。返回placement dict，没有合适的位置返回None
+        print('alienIndex:',self.alienDict[alienIndex])
+        src,maskWhite=self.sprite(alienIndex)
+        ## random flip, the mask with the sprite
+        if random.randint(0, 1) ==1:
+            src=cv2.flip(src,1)
+            maskWhite=cv2.flip(maskWhite,1)
+        scaleRatio=float(self.alienDict[alienIndex]['scaleRatio'])
+        assert len(src.shape)>2
+        assert scaleRatio>0
+        assert scaleRatio<1
+        # 是否用mixclone，which seamlessclone method to use
+        mixclone=self.alienDict[alienIndex]['mixTimes']
+        # poisson/pyramid/feather, blendMode from the caller(e.g. under load) overrides the config
+        if blendMode is None:
+            blendMode=self.alienDict[alienIndex].get('blendMode','poisson')
+
+        # adjust the size of src(alien) depend on the user`s image
+        if src.shape[0]<src.shape[1]:
+
+            srcRatio=min(image.shape[:2])*scaleRatio/src.shape[0]
+        else:
+            srcRatio=min(image.shape[:2])*scaleRatio/src.shape[1]
+        ## 随机大小 0.8~1
+        srcRatio*=random.uniform(0.8, 1)
+        ## 对src图片进行缩放
+        src=cv2.resize(src,None,fx=srcRatio,fy=srcRatio)
+        print('mix_clone =',mixclone,'src newsize',src.shape)
+        
+        #可根据实际效果调整dilateratio的值
+        dilateRatio=0.1
+        if mixclone==1:
+            dilateRatio+=0.1
+        # 
+        if occupancy is None:
+            leftTop=cloneLeftTop(pred,src,areaIndex,dilateRatio)
+        else:
+            leftTop=occupancy.cloneLeftTop(src,areaIndex,dilateRatio)
+
+        #
+        if len(leftTop)==0:
+            return None
+        print('leftTop',leftTop)
+        #
+        if mixclone>0 and blendMode=='poisson':
+            # src（外星pet图像）整个复制，复制进去将是一个正方形或长方形的图用于粘贴到底图
+            maskSrc=255*np.ones(src.shape,src.dtype)
+        else:
+            # src图像（外星pet图像）中，亮度超过threshold的会变透明,其他非透明部分会用于粘贴到底图
+            # 非poisson的融合没有mixclone的效果，白底也要去掉
+            maskSrc=cv2.resize(maskWhite,(src.shape[1],src.shape[0]),interpolation=cv2.INTER_NEAREST)
+        #maskSrc=255*np.ones(src.shape,src.dtype)
+        print('maskSrc',maskSrc.shape)
+        # box of the whole sprite, for the occupancy map
+        box=[leftTop[0],leftTop[1],leftTop[0]+src.shape[1],leftTop[1]+src.shape[0]]
+        src,maskSrc,leftTop,rightdown,x1,x2,y1,y2=roiAreaCheck(src,maskSrc,image,leftTop)
+
+        center=leftTop2Center(leftTop,src)
+        if self.debug:
+            cv2.imwrite('src.jpg',src)
+            cv2.imwrite('maskSrc.jpg',maskSrc)
+        print('center',center,'maskSrc',maskSrc.shape)
+        return {'alienIndex':alienIndex,'areaIndex':areaIndex,'src':src,'maskSrc':maskSrc,
+                'leftTop':leftTop,'rightdown':rightdown,'center':center,'box':box,
+                'flags':cv2.MIXED_CLONE if mixclone>0 else cv2.NORMAL_CLONE,'blendMode':blendMode}
+
+    def blend(self,combine,image,pred,placement,margin=None):
+        # 把placement的外星pet融合进combine(in place)，image为未融合前的图
+        # margin: sprite box外被融合改变的像素范围，默认由融合方式决定(CVTools.blendMargin)
+        #combine=cv2.seamlessClone(maskSrc,image,maskSrc,center,cv2.NORMAL_CLONE)
+        combine=CVTools.blendClone(placement['src'],combine,placement['maskSrc'],placement['center'],
+                                   placement['flags'],placement['blendMode'],out=combine)
+        areaIndex=placement['areaIndex']
+        if self.debug:
+            cv2.imwrite('combine.jpg',combine)
+            cv2.imwrite('mask'+str(areaIndex)+'.jpg',np.where(pred==areaIndex,255,0))
+        if self.alienDict[placement['alienIndex']]['mask']==1:
+            print('combine',combine.shape,image.shape)
+            # 根据pred 图像中的index，符合出现的areaindex的像素点，则用合成图combine的颜色 否则用image图的颜色
+            # 只有sprite所在的box会被改变
+            if margin is None:
+                margin=CVTools.blendMargin(placement['blendMode'])
+            x1,y1=np.array(placement['leftTop'])-margin
+            x2,y2=np.array(placement['rightdown'])+margin
+            CVTools.maskedMerge(image,combine,pred,areaIndex,[x1,y1,x2,y2],inside=False)
+        return combine
+
+    def moved(self,placement,offset,image):
+        # placement moved by offset [dx,dy] in image(frames of a clip), None if the sprite is out of the image
+        src,maskSrc=placement['src'],placement['maskSrc']
+        leftTop=np.array(placement['leftTop'])+np.round(offset).astype('int32')
+        if leftTop[0]>=image.shape[1] or leftTop[1]>=image.shape[0] or \
+                leftTop[0]+src.shape[1]<=0 or leftTop[1]+src.shape[0]<=0:
+            return None
+        src,maskSrc,leftTop,rightdown,x1,x2,y1,y2=roiAreaCheck(src,maskSrc,image,leftTop)
+        if src.size==0 or np.max(maskSrc)==0:
+            return None
+        moved=dict(placement)
+        moved.update({'src':src,'maskSrc':maskSrc,'leftTop':leftTop,'rightdown':rightdown,
+                      'center':leftTop2Center(leftTop,src)})
+        return moved
+
+    def process(self,image,pred,classNums,alienIndex,candidates=None,blendMode=None):
         #
         #rc,pred=self.seg.run(image)
         # print(list(rc.keys())[0],'begin add pet',alienIndex)
         try:
             classOkArea=self.checkClassArea(pred,classNums)
             #print('classOkArea',list(classOkArea.keys()))
-            alienIndex,areaIndex=self.chooseCheckAlien(alienIndex,classOkArea)
+            alienIndex,areaIndex=self.chooseCheckAlien(alienIndex,classOkArea,candidates)
             print('alienIndex,areaIndex',alienIndex,areaIndex)
             if alienIndex>0:
-                print('alienIndex:',self.alienDict[alienIndex])
-                print('read pic:',os.path.join(self.petPicPath,self.alienDict[alienIndex]['picPath']))
-                src=cv2.imread(os.path.join(self.petPicPath,self.alienDict[alienIndex]['picPath']))
-                ## random flip
-                src=randomFlip(src)
-                scaleRatio=float(self.alienDict[alienIndex]['scaleRatio'])
-                assert len(src.shape)>2
-                assert scaleRatio>0
-                assert scaleRatio<1
-                # 是否用mixclone，which seamlessclone method to use
-                mixclone=self.alienDict[alienIndex]['mixTimes']
-
-                # adjust the size of src(alien) depend on the user`s image
-                if src.shape[0]<src.shape[1]:
-
-                    srcRatio=min(image.shape[:2])*scaleRatio/src.shape[0]
-                else:
-                    srcRatio=min(image.shape[:2])*scaleRatio/src.shape[1]
-                ## 随机大小 0.8~1
-                srcRatio*=random.uniform(0.8, 1)
-                ## 对src图片进行缩放
-                src=cv2.resize(src,None,fx=srcRatio,fy=srcRatio)
-                print('mix_clone =',mixclone,'src newsize',src.shape)
-                
-                #可根据实际效果调整dilateratio的值
-                dilateRatio=0.1
-                if mixclone==1:
-                    dilateRatio+=0.1
-                # 
-                leftTop=cloneLeftTop(pred,src,areaIndex,dilateRatio)
-
-                #
-                if len(leftTop)>0:
-                    print('leftTop',leftTop)
-                    #
-                    if mixclone>0:
-                        # src（外星pet图像）整个复制，复制进去将是一个正方形或长方形的图用于粘贴到底图
-                        maskSrc=255*np.ones(src.shape,src.dtype)
-                    else:
-                        # src图像（外星pet图像）中，亮度超过threshold的会变透明,其他非透明部分会用于粘贴到底图
-                        maskSrc=maskOfWhiteBG(src,threshold=240)
-                    #maskSrc=255*np.ones(src.shape,src.dtype)
-                    print('maskSrc',maskSrc.shape)
-                    src,maskSrc,leftTop,rightdown,x1,x2,y1,y2=roiAreaCheck(src,maskSrc,image,leftTop)
-
-                    center=leftTop2Center(leftTop,src)
-                    if self.debug:
-                        cv2.imwrite('src.jpg',src)
-                        cv2.imwrite('maskSrc.jpg',maskSrc)
-                    print('center',center,'maskSrc',maskSrc.shape)
-
-                    #print(src.dtype,image.dtype,maskSrc.dtype)
-                    if mixclone>0:
-
-                        #combine=cv2.seamlessClone(maskSrc,image,maskSrc,center,cv2.NORMAL_CLONE)
-                        combine=cv2.seamlessClone(src,image,maskSrc,center,cv2.MIXED_CLONE)
-
-                    else:
-
-                        combine=cv2.seamlessClone(src,image,maskSrc,center,cv2.NORMAL_CLONE)
-
-
-                    if self.debug:
-                        cv2.imwrite('combine.jpg',combine)
-                        cv2.imwrite('mask'+str(areaIndex)+'.jpg',np.where(pred==areaIndex,255,0))
-                    if self.alienDict[alienIndex]['mask']==1:
-                        print('combine',combine.shape,image.shape)
-                        # 根据pred 图像中的index，符合出现的areaindex的像素点，则用合成图combine的颜色 否则用image图的颜色
-                        combine[:,:,0]=np.where(pred==areaIndex,combine[:,:,0],image[:,:,0])
-                        combine[:,:,1]=np.where(pred==areaIndex,combine[:,:,1],image[:,:,1])
-                        combine[:,:,2]=np.where(pred==areaIndex,combine[:,:,2],image[:,:,2])
+                placement=self.plan(image,pred,alienIndex,areaIndex,blendMode)
+                if placement is not None:
+                    combine=self.blend(image.copy(),image,pred,placement)
 
                     return self.resultCode[4],combine,self.alienDict[alienIndex]
 
@@ -168,14 +232,91 @@ class alienPetClass():
             print('行号', e.__traceback__.tb_lineno)
         
             return self.resultCode[0],image,{}
+
+    def processMulti(self,image,pred,classNums,count,alienIndex,candidates=None,blendMode=None):
+        # 一次放置最多count只外星pet，每种外星生物最多一只：区域统计和每个区域的积分图只算一次，sprite之间不重叠，全部融合进同一张图
+        try:
+            classOkArea=self.checkClassArea(pred,classNums)
+            pool=self.alienPool(alienIndex,classOkArea,candidates)
+            print('alien pool',pool,'count',count)
+            occupancy=occupancyClass(pred)
+            combine=image.copy()
+            placed=[]
+            while len(placed)<count and len(pool)>0:
+                al=random.choice(pool)
+                placement=self.plan(image,pred,al,self.alienDict[al]['areaIndex'],blendMode,occupancy)
+                # placed, or no room left for this alien: it is not chosen again
+                pool.remove(al)
+                if placement is None:
+                    continue
+                occupancy.occupy(placement['box'])
+                self.blend(combine,image,pred,placement)
+                placed.append(self.alienDict[al])
+            if len(placed)>0:
+                return self.resultCode[4],combine,placed
+            return self.resultCode[8],image,[]
+        except Exception as e:
+            print('alien pet module error:',e)
+            print('文件', e.__traceback__.tb_frame.f_globals['__file__'])
+            print('行号', e.__traceback__.tb_lineno)
+
+            return self.resultCode[0],image,[]
             
-    def run(self,image,classMask,classNums,alienIndex=0):      #index=0 is random
+    def run(self,image,classMask,classNums,alienIndex=0,candidates=None,blendMode=None):      #index=0 is random
         image=np.array(image,'uint8')
         if alienIndex<0 or alienIndex>len(self.alienDict):
             print('alienIndex not correct',alienIndex)
             return self.resultCode[5],image,{}
         
-        return self.process(image,classMask,classNums, alienIndex)
+        return self.process(image,classMask,classNums, alienIndex,candidates,blendMode)
+
+    def runMulti(self,image,classMask,classNums,count=3,alienIndex=0,candidates=None,blendMode=None):
+        # 返回的dic为已放置的外星生物list
+        image=np.array(image,'uint8')
+        if alienIndex<0 or alienIndex>len(self.alienDict):
+            print('alienIndex not correct',alienIndex)
+            return self.resultCode[5],image,[]
+
+        return self.processMulti(image,classMask,classNums,count,alienIndex,candidates,blendMode)
+
+class occupancyClass():
+    ## 多只pet的放置：每个区域(及dilate后的区域)的积分图只算一次，已放置的sprite记在occupancy中，防止重叠
+    def __init__(self,pred,gap=2):
+        self.pred=pred
+        self.gap=gap # pixels kept between two sprites
+        self.occupancy=np.zeros(pred.shape[:2],'uint8')
+        self.occupancyIntegral=cv2.integral(self.occupancy)
+        self.areaIntegrals={}
+
+    def areaIntegral(self,areaIndex,dilateRatio=None):
+        key=(areaIndex,dilateRatio)
+        if key not in self.areaIntegrals:
+            pred=self.pred if dilateRatio is None else dilate(self.pred,areaIndex,ratio=dilateRatio)
+            self.areaIntegrals[key]=cv2.integral(areaMask(pred,areaIndex))
+        return self.areaIntegrals[key]
+
+    def fitPositions(self,srcSize,areaIndex,dilateRatio=None):
+        fit=areaFit(self.areaIntegral(areaIndex,dilateRatio),srcSize)
+        # the sprite takes [c-size,c), no placed sprite in it
+        h,w=srcSize[0]+2*self.gap,srcSize[1]+2*self.gap
+        free=boxSum(self.occupancyIntegral,h,w,srcSize[0]+self.gap,srcSize[1]+self.gap)==0
+        return np.argwhere(fit&free)
+
+    def cloneLeftTop(self,src,areaIndex,dilateRatio=0.1):
+        srcSize=np.array(src.shape[:2],'int32')
+        predStay=self.fitPositions(srcSize,areaIndex)
+        if len(predStay)==0:
+            predStay=self.fitPositions(srcSize,areaIndex,dilateRatio)
+        print('predStay',len(predStay))
+        if len(predStay)==0:
+            return []
+        ars=predStay[random.randint(0,len(predStay)-1)]
+        return np.array([ars[1]-srcSize[1],ars[0]-srcSize[0]],'int32')# [x,y]
+
+    def occupy(self,box):
+        x1,y1=max(box[0],0),max(box[1],0)
+        self.occupancy[y1:max(box[3],0),x1:max(box[2],0)]=1
+        self.occupancyIntegral=cv2.integral(self.occupancy)
 
 def leftTop2Center(leftTop,src):
     # 根据左上角点，换算回中心点
@@ -186,28 +327,48 @@ def randomFlip(src):
     if random.randint(0, 1) ==1:
         src=cv2.flip(src,1)
     return src
-def erode2LeftTop(srcSize,pred,areaIndex,ratio=1):
-    leftTop=[]
-    ## erode核，看效果定义ratio
-    kernel=np.ones((int(ratio*srcSize[0]),int(ratio*srcSize[1])),np.uint8)
-    ##
-    if kernel.shape[0]%2==0:
-        kernel=kernel[:kernel.shape[0]-1,:]
-    if kernel.shape[1]%2==0:
-        kernel=kernel[:,:kernel.shape[1]-1]
-    predMask=np.where(pred==areaIndex,1,0)
+def oddKernel(size):
+    # 核的尺寸保持奇数，anchor在中心
+    size=max(int(size),1)
+    if size%2==0:
+        size-=1
+    return max(size,1)
+
+def boxSum(integral,kh,kw,ay,ax):
+    # summed-area table: 每个像素以(ay,ax)为anchor的kh*kw窗口内的和，窗口超出图像的部分裁掉
+    height,width=integral.shape[0]-1,integral.shape[1]-1
+    ys=np.arange(height)-ay
+    xs=np.arange(width)-ax
+    y0=np.clip(ys,0,height)
+    y1=np.clip(ys+kh,0,height)
+    x0=np.clip(xs,0,width)
+    x1=np.clip(xs+kw,0,width)
+    return integral[np.ix_(y1,x1)]-integral[np.ix_(y0,x1)]-integral[np.ix_(y1,x0)]+integral[np.ix_(y0,x0)]
+
+def areaMask(pred,areaIndex):
+    predMask=np.array(pred==areaIndex,'uint8')
     #
     predMask[:,0]=0
     predMask[:,-1]=0
     predMask[0,:]=0
     predMask[-1,:]=0
-    predMask=np.array(predMask,'uint8')
+    return predMask
+
+def areaFit(integral,srcSize,ratio=1):
+    # 与erode等价：窗口内全部是areaIndex的位置，用积分图代替大核erode
+    ## erode核，看效果定义ratio
+    kh=oddKernel(ratio*srcSize[0])
+    kw=oddKernel(ratio*srcSize[1])
+    return boxSum(integral,kh,kw,kh//2,kw//2)==kh*kw
+
+def erode2LeftTop(srcSize,pred,areaIndex,ratio=1):
+    leftTop=[]
+    predMask=areaMask(pred,areaIndex)
     
-    print(predMask.shape,kernel.shape)
-    # erode后的作为mask
-    stay=cv2.erode(predMask,kernel)
+    print(predMask.shape,srcSize)
+    stay=areaFit(cv2.integral(predMask),srcSize,ratio)
 
-    predStay=np.argwhere(stay==1)#[y,x]
+    predStay=np.argwhere(stay)#[y,x]
     print('predStay',len(predStay))
     if len(predStay)>0:
         
@@ -216,14 +377,19 @@ def erode2LeftTop(srcSize,pred,areaIndex,ratio=1):
     return leftTop
 
 def dilate(predMask,areaIndex,ratio=1):
-    # 封装dilate，确保dilate的kernel是奇数，防止报错
-    kernel=np.ones((int(ratio*predMask.shape[0]),int(ratio*predMask.shape[1])),np.uint8)
-    ##
-    if kernel.shape[0]%2==0:
-        kernel=kernel[:kernel.shape[0]-1,:]
-    if kernel.shape[1]%2==0:
-        kernel=kernel[:,:kernel.shape[1]-1]
-    return cv2.dilate(predMask,kernel)
+    # 等价于对label图做大核dilate再取==areaIndex：窗口内有areaIndex且没有更大的label
+    # 返回的图只保证==areaIndex的位置与dilate一致，其他位置为255
+    kh=oddKernel(ratio*predMask.shape[0])
+    kw=oddKernel(ratio*predMask.shape[1])
+    has=boxSum(cv2.integral(np.array(predMask==areaIndex,'uint8')),kh,kw,kh//2,kw//2)>0
+    larger=boxSum(cv2.integral(np.array(predMask>areaIndex,'uint8')),kh,kw,kh//2,kw//2)>0
+    if areaIndex==0:
+        # dilate的边界值是0，超出图像的窗口也算包含0
+        height,width=predMask.shape[:2]
+        ys=np.arange(height)-kh//2
+        xs=np.arange(width)-kw//2
+        has|=((ys<0)|(ys+kh>height))[:,None]|((xs<0)|(xs+kw>width))[None,:]
+    return np.where(has&~larger,areaIndex,255).astype('uint8')
 
 def cloneLeftTop(pred,src,areaIndex,dilateRatio=0.1): 
     #
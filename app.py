@@ -1,15 +1,149 @@
+## thread budget first, before numpy/paddle/cv2 start their thread pools
+from runtimeTools import applyThreadBudget,stageTimer
+applyThreadBudget()
 from flask import Flask, request, jsonify
+import os
 import json
+import base64
+import threading
 # from collections import deque
 import time
-from ImgGenerateModule import imgGenerator
+from runtimeTools import lockFile
 import CVTools
-import cv2
+from ConfigPet import config as petConfig
+from encoderModule import encoderClass,imgExtensions
+from sessionModule import sessionManager
+from shmRing import ringPool
+from pipelineModule import imagePipeline,parseSizes
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
 app.config['JSONIFY_MIMETYPE'] = "application/json;charset=utf-8"
 
-picPath='result.jpg'
+## the result is encoded in memory, progressive JPEG is smaller and shows earlier in WeChat
+encoder=encoderClass(imgFormat='jpg',quality=95,progressive=True)
+## the models, the ring, the sessions and the pipeline are made on first use
+## with IMG_WORKERS>0 the models are loaded in the worker processes, this process loads them only for the sessions
+lazyLock=threading.RLock()
+imgGenerator=None
+sessions=None
+ringWorkers=None
+ringLockFile=None
+imgPipeline=None
+imgWorkers=int(os.getenv('IMG_WORKERS','0'))
+ringLockPath='/tmp/superInterstellar_ring.lock'
+
+def getGenerator():
+    global imgGenerator
+    with lazyLock:
+        if imgGenerator is None:
+            from ImgGenerateModule import imgGenerator as generator
+            imgGenerator=generator
+    return imgGenerator
+
+def getSessions():
+    ## streaming AR: per-session state kept between frames, released after ttl seconds without a frame
+    global sessions
+    with lazyLock:
+        if sessions is None:
+            sessions=sessionManager(getGenerator(),ttl=60)
+    return sessions
+
+def getRing():
+    ## IMG_WORKERS>0: images are processed by worker processes, handed over through a shared memory ring(shmRing.py)
+    ## made by the first request, so the reloader parent of flask debug and the spawned workers importing this file have none
+    ## one ring per server: run one front-end process(gunicorn -w 1 --threads N), a second one finds the lock
+    ## file taken and processes in-process, loading its own models
+    global ringWorkers,ringLockFile
+    if imgWorkers<=0:
+        return None
+    with lazyLock:
+        if ringLockFile is None:
+            ringLockFile=lockFile(ringLockPath) or False
+            if ringLockFile:
+                ringWorkers=ringPool(workers=imgWorkers,slots=int(os.getenv('IMG_SLOTS','8')))
+            else:
+                print('shm ring: another process of this server has the ring, images are processed in this process')
+    return ringWorkers
+
+## IMG_PIPELINE=1: decode/analyze/compose/encode of different requests overlap in per-stage thread pools(pipelineModule.py)
+## IMG_PIPELINE_SIZES='decode:1,analyze:1,compose:2,encode:1', IMG_PIPELINE_THREADS>0 retunes the sizes from the stage times
+def encodeItem(item):
+    return encodeResult(item['dst'],item['rc'],item['img'],item['dic'],*item['encode'])
+def getPipeline():
+    global imgPipeline
+    if os.getenv('IMG_PIPELINE','0')!='1':
+        return None
+    with lazyLock:
+        if imgPipeline is None:
+            imgPipeline=imagePipeline(getGenerator(),encodeItem,sizes=parseSizes(os.getenv('IMG_PIPELINE_SIZES','compose:2')),
+                                      tuneThreads=int(os.getenv('IMG_PIPELINE_THREADS','0')))
+    return imgPipeline
+
+if imgWorkers<=0:
+    # in-process: the models are loaded at start
+    getGenerator()
+    getPipeline()
+
+def workingSize():
+    # input size of the processing, for the responses built against the input
+    ring=getRing()
+    return ring.inputSize if ring is not None else getGenerator().inputSize
+
+def formInt(name,default):
+    try:
+        return int(request.form.get(name,default))
+    except Exception as e:
+        print(e)
+        return default
+
+def deltaPatches(dst,img,imgFormat,imgQuality,maxCoverage=0.5):
+    # only the changed areas of img, against the input at the working size. None: changed too much, send the whole image
+    inputSize=workingSize()
+    scale=inputSize/max(dst.shape[:2])
+    base=CVTools.minimizeInput(dst,inputSize)
+    if base.shape!=img.shape:
+        return None
+    boxes=CVTools.changedBoxes(base,img)
+    area=sum([(x2-x1)*(y2-y1) for x1,y1,x2,y2 in boxes])
+    print('delta boxes',len(boxes),'coverage %.3f'%(area/float(img.shape[0]*img.shape[1])))
+    if area>maxCoverage*img.shape[0]*img.shape[1]:
+        return None
+    patches=[{'x':x1,'y':y1,'img':encoder.run(img[y1:y2,x1:x2],imgFormat,imgQuality)} for x1,y1,x2,y2 in boxes]
+    return {'patches':patches,'scale':scale,'input_size':[img.shape[1],img.shape[0]]}
+
+def revealAnimation(dst,img,imgFormat,imgQuality,targetBytes):
+    # (base64, format) of the fade in from the input to img
+    # None: nothing or too much changed, or over targetBytes, send the still image
+    base=CVTools.minimizeInput(dst,workingSize())
+    if base.shape!=img.shape:
+        return None
+    revealFormat=encoder.revealFormat(imgFormat)
+    if targetBytes and targetBytes>0:
+        data=encoder.runReveal(base,img,revealFormat,quality=imgQuality,targetBytes=targetBytes)
+        return None if data is None else (data,revealFormat)
+    # no byte budget: the animation only if it is not larger than the still image, else the still one already encoded
+    still=encoder.encode(img,imgFormat,imgQuality)
+    data=encoder.runReveal(base,img,revealFormat,quality=imgQuality,targetBytes=len(still))
+    if data is None:
+        return base64.b64encode(still).decode('utf8'),imgFormat
+    return data,revealFormat
+
+def encodeResult(dst,rc,img,des,imgFormat,imgQuality,targetBytes,responseMode):
+    # response of a processed image: the whole image, the changed patches or the reveal animation
+    base64img=''
+    delta=None
+    if list(rc.keys())[0]>=200 and len(img)>0:
+        with stageTimer('encode'):
+            delta=deltaPatches(dst,img,imgFormat,imgQuality) if responseMode=='delta' else None
+            reveal=revealAnimation(dst,img,imgFormat,imgQuality,targetBytes) if responseMode=='reveal' else None
+            if reveal is not None:
+                base64img,imgFormat=reveal
+            elif delta is None:
+                base64img=encoder.run(img,imgFormat,imgQuality,targetBytes)
+    rp={'result_code':rc,'img':base64img,'param_dicts':des,'img_format':imgFormat}
+    if delta is not None:
+        rp.update(delta)
+    return rp
 
 @app.route("/test")
 def index():
@@ -46,6 +180,36 @@ def users():
     except Exception as e:
         print(e)
 
+    # number of alien pets in one picture, default 1, at most one per kind of alien
+    try:
+        alienPetCount=int(request.form.get('alienPetCount',1))
+    except Exception as e:
+        print(e)
+        alienPetCount=1
+    alienPetCount=max(1,min(alienPetCount,len(petConfig['alien'])))
+
+    # 1: every face of the picture becomes the alien, default only the tallest face
+    try:
+        allFaces=int(request.form.get('allFaces',0))==1
+    except Exception as e:
+        print(e)
+        allFaces=False
+
+    # output encoding: imgFormat jpg/webp, imgQuality 1~100, targetBytes>0 finds the quality within the byte budget
+    imgFormat=request.form.get('imgFormat','jpg')
+    if imgFormat not in imgExtensions:
+        print('imgFormat not supported',imgFormat)
+        return jsonify({'result_code': {91:'input param fail'},'img':'','param_dicts':[]})
+    try:
+        imgQuality=int(request.form.get('imgQuality',encoder.quality))
+        targetBytes=int(request.form.get('targetBytes',0))
+    except Exception as e:
+        print(e)
+        imgQuality,targetBytes=encoder.quality,0
+    # full: the whole image, delta: only the changed patches of the image at the working size
+    # reveal: gif(webp if imgFormat is webp) of the alien fading in
+    responseMode=request.form.get('responseMode','full')
+
 
     if query == None :
         print('query is NONE')
@@ -57,17 +221,26 @@ def users():
             if vegetateIndex==None:vegetateIndex = -1
             if environmentIndex==None:environmentIndex = -1
             if alienPetIndex==None:alienPetIndex = -1
-            base64img=''
-            dst=CVTools.base64CV(query)
-            #cv2.imwrite('dst.jpg',dst)
-            assert len(dst.shape)>2
-            print('dst img shape',dst.shape,'begin run IMG',alienHeadIndex,vegetateIndex,environmentIndex,alienPetIndex)
-            rc, img, des = imgGenerator.runImg(dst, alienHeadIndex=alienHeadIndex,
-                                vegetateIndex=vegetateIndex, environmentIndex=environmentIndex,alienPetIndex=alienPetIndex)
-            if list(rc.keys())[0]>=200 and len(img)>0:
-                cv2.imwrite(picPath,img)
-                base64img=CVTools.picpath2base64(picPath)
-            rp= {'result_code':rc,'img':base64img,'param_dicts':des}
+            params=dict(alienHeadIndex=alienHeadIndex,vegetateIndex=vegetateIndex,environmentIndex=environmentIndex,
+                        alienPetIndex=alienPetIndex,alienPetCount=alienPetCount,allFaces=allFaces)
+            ringWorkers=getRing()
+            imgPipeline=getPipeline() if ringWorkers is None else None
+            if imgPipeline is not None:
+                # decode, analyze, compose and encode run in the stage pools, overlapping with other requests
+                rp=imgPipeline.submit({'query':query,'params':params,
+                                       'encode':(imgFormat,imgQuality,targetBytes,responseMode)}).result()
+            else:
+                dst=CVTools.base64CV(query)
+                #cv2.imwrite('dst.jpg',dst)
+                assert len(dst.shape)>2
+                print('dst img shape',dst.shape,'begin run IMG',alienHeadIndex,vegetateIndex,environmentIndex,alienPetIndex)
+                if ringWorkers is not None:
+                    # img is in the shared memory slot, encode it before the slot is released
+                    with ringWorkers.process(dst,**params) as (rc,img,des):
+                        rp=encodeResult(dst,rc,img,des,imgFormat,imgQuality,targetBytes,responseMode)
+                else:
+                    rc, img, des = getGenerator().runImg(dst,**params)
+                    rp=encodeResult(dst,rc,img,des,imgFormat,imgQuality,targetBytes,responseMode)
 
         except Exception as e:
             print('poemer error:', e)
@@ -78,5 +251,47 @@ def users():
 
     return jsonify(rp)
 
+@app.route("/session/start", methods=["POST"])
+def sessionStart():
+    # alien indexes are fixed for the whole session, 0 is chosen randomly once
+    sessions=getSessions()
+    sessionId=sessions.start(alienHeadIndex=formInt('alienHeadIndex',-1),vegetateIndex=formInt('vegetateIndex',-1),
+                             enviromentIndex=formInt('environmentIndex',-1),alienPetIndex=formInt('alienPetIndex',-1))
+    if sessionId is None:
+        return jsonify({'result_code':{94:'too many sessions'},'session_id':''})
+    return jsonify({'result_code':{200:'success'},'session_id':sessionId,'ttl':sessions.ttl})
+
+@app.route("/session/frame", methods=["POST"])
+def sessionFrame():
+    # one frame of the session, processed with the state of the previous frames
+    sessionId=request.form.get('session_id')
+    query=request.form.get('query')
+    imgFormat=request.form.get('imgFormat','jpg')
+    imgQuality=formInt('imgQuality',encoder.quality)
+    targetBytes=formInt('targetBytes',0)
+    responseMode=request.form.get('responseMode','full')
+    if query is None or sessionId is None or imgFormat not in imgExtensions:
+        return jsonify({'result_code': {91:'input param fail'},'img':'','param_dicts':[]})
+    try:
+        dst=CVTools.base64CV(query)
+        assert dst is not None and len(dst.shape)>2
+        sessions=getSessions()
+        result=sessions.run(sessionId,dst)
+        if result is None:
+            return jsonify({'result_code':{93:'session not found or expired'},'img':'','param_dicts':[]})
+        rc,img,des,faceBox=result
+        rp=encodeResult(dst,rc,img,des,imgFormat,imgQuality,targetBytes,responseMode)
+        rp['face_box']=faceBox
+    except Exception as e:
+        print('session frame error:', e)
+        rp={'result_code': {92:'pre or after process fail'},'img':'','param_dicts':[]}
+    return jsonify(rp)
+
+@app.route("/session/end", methods=["POST"])
+def sessionEnd():
+    if getSessions().end(request.form.get('session_id')):
+        return jsonify({'result_code':{200:'success'}})
+    return jsonify({'result_code':{93:'session not found or expired'}})
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8001, debug=True)  # 启动app的调试模式
\ No newline at end of file
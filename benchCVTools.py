@@ -0,0 +1,87 @@
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import CVTools
+
+## CVTools 合成kernel的microbenchmark: 与旧实现对比输出是否一致，以及耗时与内存分配
+## python benchCVTools.py [loops]
+
+def gradientMaskOld(maskHead3,lowestValue=126,heightGradientBias=0.5):
+    height=maskHead3.shape[0]
+    for i in range(height) :
+        if i/height>heightGradientBias:
+            afterGradient=int(255-(255-lowestValue)*(i-heightGradientBias*height)/(height*(1-heightGradientBias)))
+            maskHead3[i,:,:] = np.where(maskHead3[i,:,:]==255,afterGradient,0)
+    maskHead3=np.array(maskHead3,'uint8')
+    maskHead3=np.clip(maskHead3,0,255)
+    return maskHead3
+def addWeightOld(fg,bg,ratio,mask=None,gamma=0):
+    if mask is not None:
+        result=fg*(mask/255)*ratio+bg*ratio*(1-mask/255)+gamma
+        result=np.clip(result,0,255)
+    else:
+        result=fg*ratio*0.5+bg*ratio*0.5+gamma
+    return result
+def mask3ChannelOld(mask,src):
+    maskPic = 255 * np.ones(src.shape, src.dtype)
+    maskPic[:,:,0]=mask
+    maskPic[:,:,1] = mask
+    maskPic[:,:,2] = mask
+    return maskPic
+def hardPasteOld(dstOri,newleftTop,newrightDown,maskHead3,srcHead):
+    hardPaste1=dstOri[newleftTop[1]:newrightDown[1],newleftTop[0]:newrightDown[0],:]
+    hardPaste1=np.where(maskHead3==255,srcHead,hardPaste1)
+    dstOri[newleftTop[1]:newrightDown[1],newleftTop[0]:newrightDown[0],:]=hardPaste1
+    return dstOri
+
+def measure(func,args,loops):
+    # (mean seconds, peak bytes allocated by numpy/python during one call)
+    func(*[a.copy() if isinstance(a,np.ndarray) else a for a in args])
+    t1=time.perf_counter()
+    for i in range(loops):
+        func(*[a.copy() if isinstance(a,np.ndarray) else a for a in args])
+    seconds=(time.perf_counter()-t1)/loops
+    copies=[a.copy() if isinstance(a,np.ndarray) else a for a in args]
+    tracemalloc.start()
+    func(*copies)
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds,peak
+
+def makeInputs(height=525,width=700,sprite=260,seed=0):
+    rng=np.random.RandomState(seed)
+    dst=rng.randint(0,256,(height,width,3)).astype('uint8')
+    src=rng.randint(0,256,(sprite,sprite,3)).astype('uint8')
+    alpha=np.zeros((sprite,sprite),'uint8')
+    cv2.circle(alpha,(sprite//2,sprite//2),sprite//2-4,255,-1)
+    mask3=cv2.merge((alpha,alpha,alpha))
+    maskDst=np.zeros(dst.shape,'uint8')
+    maskDst[100:100+sprite,200:200+sprite]=CVTools.gradientMask(mask3.copy(),10,0.6)
+    return dst,src,alpha,mask3,maskDst
+
+def run(loops=20):
+    dst,src,alpha,mask3,maskDst=makeInputs()
+    fg=dst.copy()
+    leftTop=np.array([200,100])
+    rightDown=leftTop+[src.shape[1],src.shape[0]]
+    cases=[
+        ('gradientMask',gradientMaskOld,CVTools.gradientMask,(mask3,10,0.6),0),
+        ('mask3Channel',mask3ChannelOld,CVTools.mask3Channel,(alpha,src),0),
+        ('hardPaste',hardPasteOld,CVTools.hardPaste,(dst,leftTop,rightDown,mask3,src),0),
+        ('addWeight',addWeightOld,CVTools.addWeightU8,(fg,dst[::-1].copy(),0.8,maskDst),1),
+    ]
+    print('%-14s %10s %10s %12s %12s %8s'%('kernel','old ms','new ms','old peak KB','new peak KB','maxdiff'))
+    for name,old,new,args,tolerance in cases:
+        resultOld=old(*[a.copy() if isinstance(a,np.ndarray) else a for a in args])
+        resultNew=new(*[a.copy() if isinstance(a,np.ndarray) else a for a in args])
+        # the old addWeight returns float64, compare with its rounded uint8 value
+        diff=np.abs(np.round(resultOld).astype('int32')-resultNew.astype('int32')).max()
+        assert diff<=tolerance,(name,diff)
+        tOld,peakOld=measure(old,args,loops)
+        tNew,peakNew=measure(new,args,loops)
+        print('%-14s %10.3f %10.3f %12.1f %12.1f %8d'%(name,tOld*1000,tNew*1000,peakOld/1024,peakNew/1024,diff))
+
+if __name__=='__main__':
+    import sys
+    run(int(sys.argv[1]) if len(sys.argv)>1 else 20)
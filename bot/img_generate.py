@@ -26,6 +26,24 @@ def base64cv(img_raw_base64):
     return img_opencv
 
 
+def reconstruct(img, data: Dict):
+    """
+    用delta模式返回的patch还原完整的结果图
+
+    :param img: 发送给服务端的原图
+    :param data: 服务端返回的结果，包含`patches`, `scale`
+    :return: 服务端工作尺寸下的完整结果图
+    """
+    # 与服务端minimizeInput相同的缩放
+    result = cv2.resize(img, None, fx=data['scale'], fy=data['scale'])
+    for patch in data['patches']:
+        patch_img = base64cv(patch['img'])
+        x, y = patch['x'], patch['y']
+        result[y:y + patch_img.shape[0], x:x + patch_img.shape[1]] = patch_img
+
+    return result
+
+
 class ImgGenerator():
     """
     图像处理
@@ -75,11 +93,13 @@ class ImgGenerator():
             '光外族': 14
         }
 
-    def run(self, img_path: str, big_type: str, little_type: Optional[str] = None) -> Dict:
+    def run(self, img_path: str, big_type: str, little_type: Optional[str] = None,
+            response_mode: str = 'full') -> Dict:
         """
         图像处理
         :param img_path: 图片的路径
         :param big_type: 图像处理的模式，可选`alien`, `vegetable`, `environment`, `pet`
+        :param response_mode: `full`返回整张图，`delta`只返回改变的区域，在本地用原图还原
         :return: 图像处理的结果
 
         用法 ::
@@ -136,14 +156,17 @@ class ImgGenerator():
             'alienHeadIndex': alienhead_index,
             'vegetateIndex': vegetable_index,
             'environmentIndex': environment_index,
-            'alienPetIndex': alienpet_index
+            'alienPetIndex': alienpet_index,
+            'responseMode': response_mode
         }
         req = requests.post(url=self.url, data=data)
         data: Dict = json.loads(req.text)
         # print('data', data)
         code: int = int(list(data['result_code'].keys())[0])
         err = list(data['result_code'].values())[0]
-        if data['img']:
+        if data.get('patches') is not None:
+            img = reconstruct(cv2.imread(img_path), data)
+        elif data['img']:
             img = base64cv(data['img'])
         else:
             img = None
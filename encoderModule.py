@@ -0,0 +1,168 @@
+import io
+import base64
+import cv2
+import numpy as np
+from PIL import Image
+import CVTools
+
+## 生成图片的编码：在内存中编码为JPEG/WebP，不再经过result.jpg
+## targetBytes>0 时在缩小的proxy图上试几次quality，找到不超过字节预算的最高quality，再在原图上确认
+imgExtensions={'jpg':'.jpg','jpeg':'.jpg','webp':'.webp'}
+## reveal动画：只用原图和最终合成图，在变化区域内插值渐显，不需要逐帧推理；整个动画共用一个调色板
+## chroma subsampling of JPEG, only opencv>=4.5.5 has the flag
+samplingFactors={'420':'IMWRITE_JPEG_SAMPLING_FACTOR_420',
+                 '422':'IMWRITE_JPEG_SAMPLING_FACTOR_422',
+                 '444':'IMWRITE_JPEG_SAMPLING_FACTOR_444'}
+
+class encoderClass():
+    def __init__(self,imgFormat='jpg',quality=95,progressive=False,sampling=None,
+                 proxySize=320,minQuality=30,maxQuality=95,searchSteps=5):
+        self.imgFormat=imgFormat
+        self.quality=quality # quality when there is no targetBytes, 95 is the default of cv2.imwrite
+        self.progressive=progressive # progressive JPEG
+        self.sampling=sampling # None: libjpeg default(420), '420','422' or '444'
+        self.proxySize=proxySize # long side of the proxy image for the targetBytes search
+        self.minQuality=minQuality
+        self.maxQuality=maxQuality
+        self.searchSteps=searchSteps # trial encodes on the proxy of each search
+
+    def params(self,imgFormat,quality):
+        quality=int(quality)
+        if imgExtensions[imgFormat]=='.webp':
+            return [cv2.IMWRITE_WEBP_QUALITY,quality]
+        params=[cv2.IMWRITE_JPEG_QUALITY,quality]
+        if self.progressive:
+            params+=[cv2.IMWRITE_JPEG_PROGRESSIVE,1]
+        if self.sampling is not None:
+            flag=getattr(cv2,samplingFactors[self.sampling],None)
+            if flag is not None:
+                params+=[cv2.IMWRITE_JPEG_SAMPLING_FACTOR,flag]
+            else:
+                print('jpeg sampling factor not supported by this opencv, use the default')
+        return params
+
+    def encode(self,img,imgFormat=None,quality=None):
+        # bytes of the encoded image
+        imgFormat=(imgFormat or self.imgFormat).lower()
+        quality=self.quality if quality is None else quality
+        ok,data=cv2.imencode(imgExtensions[imgFormat],img,self.params(imgFormat,quality))
+        if not ok:
+            raise ValueError('encode fail: '+imgFormat)
+        return data.tobytes()
+
+    def search(self,proxy,budget,imgFormat):
+        # highest quality whose proxy encode is within budget, minQuality if none is
+        low,high=self.minQuality,self.maxQuality
+        best=self.minQuality
+        for i in range(self.searchSteps):
+            if low>high:
+                break
+            quality=(low+high)//2
+            if len(self.encode(proxy,imgFormat,quality))<=budget:
+                best=quality
+                low=quality+1
+            else:
+                high=quality-1
+        return best
+
+    def encodeTarget(self,img,targetBytes,imgFormat=None):
+        # (bytes, quality): the largest encode not more than targetBytes, the minQuality one if it can not fit
+        ratio=min(1.0,self.proxySize/max(img.shape[:2]))
+        if ratio==1.0:
+            proxy,scale=img,1.0
+        else:
+            proxy=cv2.resize(img,None,fx=ratio,fy=ratio,interpolation=cv2.INTER_AREA)
+            scale=img.shape[0]*img.shape[1]/float(proxy.shape[0]*proxy.shape[1])
+        quality=self.search(proxy,targetBytes/scale,imgFormat)
+        data=self.encode(img,imgFormat,quality)
+        if len(data)>targetBytes and scale>1:
+            # bytes do not grow linearly with pixels, correct the budget with the real size and search again
+            scale*=len(data)/float(len(self.encode(proxy,imgFormat,quality))*scale)
+            quality=min(quality,self.search(proxy,targetBytes/scale,imgFormat))
+            data=self.encode(img,imgFormat,quality)
+        while len(data)>targetBytes and quality>self.minQuality:
+            quality=max(self.minQuality,quality-5)
+            data=self.encode(img,imgFormat,quality)
+        print('encode target',targetBytes,'bytes',len(data),'quality',quality)
+        return data,quality
+
+    def run(self,img,imgFormat=None,quality=None,targetBytes=0):
+        # base64 string of the encoded image
+        if targetBytes and targetBytes>0:
+            data,quality=self.encodeTarget(img,targetBytes,imgFormat)
+        else:
+            data=self.encode(img,imgFormat,quality)
+        return base64.b64encode(data).decode('utf8')
+
+    def revealFrames(self,before,after,steps=8,colors=255,sampleStep=4,maxCoverage=0.5):
+        # P mode frames of the fade in, the blend and quantize only run inside the changed box
+        # None if nothing changed, or the box covers more than maxCoverage of the frame(the animation would be large)
+        boxes=CVTools.changedBoxes(before,after)
+        if len(boxes)==0:
+            return None
+        boxes=np.array(boxes)
+        x1,y1=boxes[:,0].min(),boxes[:,1].min()
+        x2,y2=boxes[:,2].max(),boxes[:,3].max()
+        if (x2-x1)*(y2-y1)>maxCoverage*before.shape[0]*before.shape[1]:
+            print('reveal box covers too much',x1,y1,x2,y2)
+            return None
+        roiBefore=cv2.cvtColor(before[y1:y2,x1:x2],cv2.COLOR_BGR2RGB)
+        roiAfter=cv2.cvtColor(after[y1:y2,x1:x2],cv2.COLOR_BGR2RGB)
+        rgbBefore=cv2.cvtColor(before,cv2.COLOR_BGR2RGB)
+        # one palette for all frames: colors of the input, the result and the area it fades from, subsampled
+        samples=np.concatenate((rgbBefore[::sampleStep,::sampleStep].reshape(-1,3),
+                                cv2.cvtColor(after[::sampleStep,::sampleStep],cv2.COLOR_BGR2RGB).reshape(-1,3),
+                                roiBefore[::sampleStep,::sampleStep].reshape(-1,3)))
+        palette=Image.fromarray(samples.reshape(-1,1,3)).quantize(colors,method=Image.FASTOCTREE)
+        base=Image.fromarray(rgbBefore).quantize(palette=palette)
+        frames=[base]
+        for i in range(1,steps+1):
+            patch=cv2.addWeighted(roiBefore,1-i/float(steps),roiAfter,i/float(steps),0)
+            frame=base.copy()# 1 byte per pixel
+            frame.paste(Image.fromarray(patch).quantize(palette=palette),(int(x1),int(y1)))
+            frames.append(frame)
+        return frames
+
+    def revealFormat(self,imgFormat):
+        # animated webp only if this Pillow can write it, else gif
+        # SAVE_ALL is filled when the plugins are loaded, which Pillow only does on the first open/save
+        Image.init()
+        return 'webp' if imgFormat=='webp' and 'WEBP' in Image.SAVE_ALL else 'gif'
+
+    def reveal(self,before,after,imgFormat='gif',steps=8,frameMs=80,holdMs=1500,quality=None,targetBytes=0,
+               maxCoverage=0.5):
+        # bytes of the animation, the last frame is held for holdMs, then loops. quality: webp only, gif is lossless
+        # None: send the still image, nothing or too much changed(maxCoverage), or more than targetBytes(>0)
+        frames=self.revealFrames(before,after,steps,maxCoverage=maxCoverage)
+        if frames is None:
+            return None
+        durations=[frameMs]*(len(frames)-1)+[holdMs]
+        buffer=io.BytesIO()
+        if self.revealFormat(imgFormat)=='webp':
+            frames=[frame.convert('RGB') for frame in frames]
+            frames[0].save(buffer,'WEBP',save_all=True,append_images=frames[1:],duration=durations,loop=0,
+                           quality=self.quality if quality is None else quality)
+        else:
+            # GIF writes only the bbox which differs from the previous frame
+            frames[0].save(buffer,'GIF',save_all=True,append_images=frames[1:],duration=durations,loop=0,optimize=False)
+        if targetBytes and targetBytes>0 and buffer.tell()>targetBytes:
+            print('reveal bytes',buffer.tell(),'over target',targetBytes)
+            return None
+        return buffer.getvalue()
+
+    def runReveal(self,before,after,imgFormat='gif',steps=8,quality=None,targetBytes=0):
+        # base64 string of the animation, None: send the still image
+        data=self.reveal(before,after,imgFormat,steps,quality=quality,targetBytes=targetBytes)
+        if data is None:
+            return None
+        return base64.b64encode(data).decode('utf8')
+
+if __name__=='__main__':
+    import time
+    img=cv2.imread('testpic/test0.jpg')
+    encoder=encoderClass(progressive=True)
+    for imgFormat in ['jpg','webp']:
+        for targetBytes in [0,60000,30000]:
+            t1=time.time()
+            b64=encoder.run(img,imgFormat,targetBytes=targetBytes)
+            print(imgFormat,targetBytes,'base64 length',len(b64),'time %.3f'%(time.time()-t1))
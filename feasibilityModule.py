@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+
+## 分割前的快速预判：在缩略图上用颜色/纹理统计，估计cityscapes的哪些类别不可能出现
+## 只对能判断的类别(road 0, vegetation 8, sky 10)给出否定，其他类别一律当作可能存在
+class feasibilityClass():
+    def __init__(self,thumbSize=96,minRatio=0.01,textureThreshold=24,debug=False):
+        self.debug=debug
+        self.thumbSize=thumbSize # long side of the thumbnail
+        self.minRatio=minRatio # ratio of thumbnail pixels, below it the class is judged absent
+        self.textureThreshold=textureThreshold # |laplacian| below it counts as flat area
+        # cityscape index -> estimator, return the ratio of pixels look like that class
+        self.estimators={0:roadRatio,8:vegetationRatio,10:skyRatio}
+
+    def thumbnail(self,image):
+        ratio=self.thumbSize/max(image.shape[:2])
+        if ratio<1:
+            image=cv2.resize(image,None,fx=ratio,fy=ratio,interpolation=cv2.INTER_AREA)
+        return image
+
+    def estimate(self,image):
+        # return {classIndex: ratio of thumbnail pixels which look like the class}
+        thumb=self.thumbnail(image)
+        hsv=cv2.cvtColor(thumb,cv2.COLOR_BGR2HSV)
+        gray=cv2.cvtColor(thumb,cv2.COLOR_BGR2GRAY)
+        flat=np.abs(cv2.Laplacian(gray,cv2.CV_16S,ksize=3))<self.textureThreshold
+        ratios={}
+        for index,estimator in self.estimators.items():
+            ratios[index]=estimator(hsv,flat)
+        if self.debug:
+            print('feasibility ratios',ratios)
+        return ratios
+
+    def run(self,image):
+        # return the set of class index which are surely not in the image
+        ratios=self.estimate(image)
+        absentAreas=set([index for index,ratio in ratios.items() if ratio<self.minRatio])
+        print('feasibility absent areas',absentAreas)
+        return absentAreas
+
+def skyRatio(hsv,flat):
+    # sky: blue or bright grey/white, flat, in the upper part of the picture
+    top=int(hsv.shape[0]*0.7)
+    h,s,v=hsv[:top,:,0],hsv[:top,:,1],hsv[:top,:,2]
+    blue=(h>=90)&(h<=135)&(s>=25)&(v>=90)
+    cloud=(s<40)&(v>=160)
+    sky=(blue|cloud)&flat[:top,:]
+    return np.count_nonzero(sky)/float(hsv.shape[0]*hsv.shape[1])
+
+def vegetationRatio(hsv,flat):
+    # vegetation: yellow-green to cyan-green with some saturation, texture is not required
+    h,s,v=hsv[:,:,0],hsv[:,:,1],hsv[:,:,2]
+    green=(h>=25)&(h<=95)&(s>=30)&(v>=25)
+    return np.count_nonzero(green)/float(hsv.shape[0]*hsv.shape[1])
+
+def roadRatio(hsv,flat):
+    # road: low saturation grey in the lower part of the picture
+    top=int(hsv.shape[0]*0.4)
+    s,v=hsv[top:,:,1],hsv[top:,:,2]
+    grey=(s<=50)&(v>=35)&(v<=220)
+    return np.count_nonzero(grey)/float(hsv.shape[0]*hsv.shape[1])
+
+if __name__=='__main__':
+    image=cv2.imread('testpic/test0.jpg')
+    fc=feasibilityClass(debug=True)
+    print(fc.run(image))
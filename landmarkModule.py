@@ -1,29 +1,75 @@
 import paddlehub as hub
 import numpy as np
+import cv2
+import time
+import queue
+import threading
+from concurrent.futures import Future
 ## https://gitee.com/PaddlePaddle/PaddleHub/tree/release/v2.1/modules/image/keypoint_detection/face_landmark_localization
 class landmarker():
-    def __init__(self,debug=False):
+    def __init__(self,debug=False,fastPath=True,detectSize=320,padRatio=0.5,batchWait=0.005,maxBatch=8):
         self.face_landmark = hub.Module(name="face_landmark_localization")
         self.debug=debug
-    def run(self, img):
-        landmarks = []
-        # print('begin baidu landmark')
-        results = self.face_landmark.keypoint_detection(images=[img],
+        ## batchWait>0: requests of concurrent jobs arriving within batchWait seconds run as one batch
+        self.batcher=landmarkBatcher(self.detectBatch,maxBatch,batchWait) if batchWait>0 else None
+        self.lock=threading.Lock()# without the batcher, one detection at a time
+        ## fastPath: find faces on a downscaled copy, then only run the landmark model on the face crop
+        self.fastPath=fastPath
+        self.detectSize=detectSize # long side of the downscaled copy
+        self.padRatio=padRatio # pad of the face crop, ratio of the face width/height
+    def detect(self, images):
+        # landmarks of every image: [[[x,y]*68] of each face]
+        if self.batcher is not None:
+            return self.batcher.submit(images)
+        with self.lock:
+            return self.detectBatch(images)
+    def detectBatch(self, images):
+        results = self.face_landmark.keypoint_detection(images=images,
                                                         paths=None,
-                                                        batch_size=1,
+                                                        batch_size=len(images),
                                                         use_gpu=False,
                                                         output_dir='face_landmark_output',
                                                         visualization=self.debug)
-        # print('emoi baidu landmark',landmarks)
-        for result in results:
-            landmarks = result['data']
-            break  # one pic one result
+        if len(images)==1:
+            return [results[0]['data'] if len(results)>0 else []]  # one pic one result
+        if len(results)!=len(images):
+            # image without face may be dropped in the results, run one by one to keep the order
+            return [self.detectBatch([img])[0] for img in images]
+        return [result['data'] for result in results]
+    def run(self, img, allFaces=True):
+        # print('begin baidu landmark')
+        if not self.fastPath or max(img.shape[:2])<=self.detectSize:
+            return self.detect([img])[0]
+        ratio=self.detectSize/max(img.shape[:2])
+        small=cv2.resize(img,None,fx=ratio,fy=ratio,interpolation=cv2.INTER_AREA)
+        coarse=[np.array(la)/ratio for la in self.detect([small])[0]]
+        if len(coarse)==0:
+            return []
+        if not allFaces:
+            coarse=[max(coarse,key=faceHeight)]
+        crops=[]
+        offsets=[]
+        for la in coarse:
+            x1,y1,x2,y2=faceBox(la,self.padRatio,img.shape)
+            crops.append(np.ascontiguousarray(img[y1:y2,x1:x2]))
+            offsets.append([x1,y1])
+        landmarks=[]
+        for la,faces,offset in zip(coarse,self.detect(crops),offsets):
+            if len(faces)==0:
+                # the crop lost the face, keep the points from the downscaled copy
+                landmarks.append(la.tolist())
+                continue
+            # the pad may contain part of another face, the tallest one is the face of the crop
+            face=max([np.array(fa) for fa in faces],key=faceHeight)
+            landmarks.append((face+offset).tolist())
+        if self.debug:
+            print('landmark fast path, faces:',len(landmarks),'ratio',ratio)
         # print('emoi baidu landmark', landmarks[0], len(landmarks[0]))
         return landmarks
     def heightestFace(self, img):
         if self.debug:
             print(img.shape)
-        landmarks=self.run(img)
+        landmarks=self.run(img,allFaces=False)
         tempHeight=0
         tempIndex=0
         for index,la in enumerate(landmarks):
@@ -38,4 +84,61 @@ class landmarker():
             
             return np.array(landmarks[tempIndex]),tempHeight
         else:
-            return [],tempHeight
\ No newline at end of file
+            return [],tempHeight
+class landmarkBatcher():
+    ## 收集几毫秒内到达的landmark请求(多个用户的换头任务,或一张图的多个人脸)，合成一个batch推理
+    def __init__(self,detectFunc,maxBatch=8,maxWait=0.005):
+        self.detectFunc=detectFunc
+        self.maxBatch=maxBatch # images of one batch, a single request larger than it still runs as one batch
+        self.maxWait=maxWait # seconds to wait for other requests after the first one arrives
+        self.requests=queue.Queue()
+        self.thread=threading.Thread(target=self.loop,daemon=True)
+        self.thread.start()
+    def submit(self,images):
+        # block until the landmarks of these images are ready
+        future=Future()
+        self.requests.put((images,future))
+        return future.result()
+    def collect(self):
+        batch=[self.requests.get()]
+        count=len(batch[0][0])
+        deadline=time.time()+self.maxWait
+        while count<self.maxBatch:
+            timeout=deadline-time.time()
+            if timeout<=0:
+                break
+            try:
+                request=self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            count+=len(request[0])
+        return batch
+    def loop(self):
+        while True:
+            batch=self.collect()
+            images=[img for imgs,future in batch for img in imgs]
+            try:
+                results=self.detectFunc(images)
+            except Exception as e:
+                for imgs,future in batch:
+                    future.set_exception(e)
+                continue
+            # give every caller the results of its own images
+            begin=0
+            for imgs,future in batch:
+                future.set_result(results[begin:begin+len(imgs)])
+                begin+=len(imgs)
+def faceHeight(landmark):
+    return np.max(landmark[:,1])-np.min(landmark[:,1])
+def faceBox(landmark,padRatio,shape):
+    # padded box of the face landmarks in the image, [x1,y1,x2,y2]
+    x1,y1=np.min(landmark,axis=0)
+    x2,y2=np.max(landmark,axis=0)
+    padX=(x2-x1)*padRatio
+    padY=(y2-y1)*padRatio
+    x1=max(0,int(x1-padX))
+    y1=max(0,int(y1-padY*1.5))# 68 points have no forehead
+    x2=min(shape[1],int(x2+padX)+1)
+    y2=min(shape[0],int(y2+padY)+1)
+    return x1,y1,x2,y2
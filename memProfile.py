@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+import cv2
+from runtimeTools import stageListeners
+
+## 图像生成各阶段的内存profile：按阶段、按输入尺寸记录 tracemalloc 分配峰值(python/numpy)、RSS峰值增量(含paddle等native分配)，以及峰值时最大的几处分配
+## python memProfile.py [图片目录或图片] [输入尺寸,逗号分隔] [输出json]
+## numpy的数组分配会报告给tracemalloc，所以峰值时的分配位置可以定位到创建数组的代码行；RSS由后台线程采样
+
+repoDir=os.path.dirname(os.path.abspath(__file__))
+pageSize=os.sysconf('SC_PAGE_SIZE') if hasattr(os,'sysconf') else 4096
+def rssBytes():
+    # resident set size of this process now, 0 if /proc is not there
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*pageSize
+    except (IOError,OSError):
+        return 0
+
+def takeSnapshot():
+    # without the allocations of tracemalloc and of this harness
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,tracemalloc.__file__),
+                                                      tracemalloc.Filter(False,__file__)])
+
+class memoryListener():
+    # runtimeTools.stageListeners: every stage records its allocation peak, RSS peak and the allocations alive at the peak
+    def __init__(self,topN=5,sampleInterval=0.002,snapshotStep=1<<20):
+        self.topN=topN
+        self.sampleInterval=sampleInterval # seconds between the samples of RSS and traced memory
+        self.snapshotStep=snapshotStep # a new snapshot when the traced memory is this much above the last one
+        self.label=None # input size of the current run
+        self.records=[]# one dict per stage run
+        self.stage=None
+    def sample(self):
+        # background thread: RSS peak, and a snapshot whenever the traced memory reaches a new peak
+        while not self.stopEvent.is_set():
+            self.rssPeak=max(self.rssPeak,rssBytes())
+            current=tracemalloc.get_traced_memory()[0]
+            self.tracedPeak=max(self.tracedPeak,current)
+            if current>self.snapshotTraced+self.snapshotStep:
+                self.snapshot=takeSnapshot()
+                self.snapshotTraced=current
+            self.stopEvent.wait(self.sampleInterval)
+    def begin(self,name):
+        if self.stage is not None:
+            # stages are not nested in ImgGenerator.process, keep the outer one
+            return
+        self.stage=name
+        if hasattr(tracemalloc,'reset_peak'):
+            tracemalloc.reset_peak()
+        self.beginSnapshot=takeSnapshot()
+        self.tracedBegin=tracemalloc.get_traced_memory()[0]
+        self.tracedPeak=self.snapshotTraced=self.tracedBegin
+        self.snapshot=None
+        self.rssBegin=self.rssPeak=rssBytes()
+        self.stopEvent=threading.Event()
+        self.sampler=threading.Thread(target=self.sample,daemon=True)
+        self.sampler.start()
+    def end(self,name,seconds):
+        if name!=self.stage:
+            return
+        self.stopEvent.set()
+        self.sampler.join()
+        self.stage=None
+        tracedEnd,tracedPeak=tracemalloc.get_traced_memory()
+        if not hasattr(tracemalloc,'reset_peak'):
+            # python<3.9: the peak since tracemalloc started, only the sampled one belongs to this stage
+            tracedPeak=self.tracedPeak
+        rssEnd=rssBytes()
+        self.records.append({'size':self.label,'stage':name,'seconds':seconds,
+                             'tracedPeak':max(tracedPeak,self.tracedPeak)-self.tracedBegin,
+                             'tracedEnd':tracedEnd-self.tracedBegin,
+                             'rssPeak':max(self.rssPeak,rssEnd)-self.rssBegin,
+                             'rssEnd':rssEnd-self.rssBegin,
+                             'top':self.topAllocations()})
+    def topAllocations(self):
+        # [file:line, bytes] allocated in the stage and alive at the sampled peak, largest first
+        # the line is the innermost one of this project, not the numpy/cv2 wrapper which made the array
+        if self.snapshot is None:
+            return []
+        sizes={}
+        for stat in self.snapshot.compare_to(self.beginSnapshot,'traceback'):
+            if stat.size_diff<=0:
+                continue
+            frames=list(stat.traceback)# oldest first
+            frame=next((frame for frame in reversed(frames) if frame.filename.startswith(repoDir)),frames[-1])
+            where='%s:%d'%(os.path.basename(frame.filename),frame.lineno)
+            sizes[where]=sizes.get(where,0)+stat.size_diff
+        return sorted([[where,size] for where,size in sizes.items()],key=lambda item:-item[1])[:self.topN]
+
+def summarize(records):
+    # {(size,stage): summary} over all images, peaks are the max of the runs
+    summary={}
+    for record in records:
+        key=(record['size'],record['stage'])
+        item=summary.setdefault(key,{'size':record['size'],'stage':record['stage'],'runs':0,'seconds':0.0,
+                                     'tracedPeak':0,'tracedEnd':0,'rssPeak':0,'top':{}})
+        item['runs']+=1
+        item['seconds']+=record['seconds']
+        for field in ['tracedPeak','tracedEnd','rssPeak']:
+            item[field]=max(item[field],record[field])
+        for where,size in record['top']:
+            item['top'][where]=max(item['top'].get(where,0),size)
+    results=[]
+    for key in sorted(summary.keys(),key=lambda key:(key[0],key[1])):
+        item=summary[key]
+        item['seconds']/=item['runs']
+        item['top']=sorted(item['top'].items(),key=lambda kv:-kv[1])[:5]
+        results.append(item)
+    return results
+
+def printTable(results):
+    MB=float(1<<20)
+    print('%6s %-12s %5s %8s %11s %10s %10s  %s'%('size','stage','runs','mean s','py peak MB','py end MB','rss up MB','largest at peak'))
+    for item in results:
+        top=', '.join(['%s %.1fMB'%(where,size/MB) for where,size in item['top'][:3]])
+        print('%6d %-12s %5d %8.3f %11.1f %10.1f %10.1f  %s'%(item['size'],item['stage'],item['runs'],item['seconds'],
+                                                             item['tracedPeak']/MB,item['tracedEnd']/MB,item['rssPeak']/MB,top))
+
+def imagePaths(path):
+    if os.path.isdir(path):
+        return [os.path.join(path,name) for name in sorted(os.listdir(path))
+                if os.path.splitext(name)[1].lower() in ['.jpg','.jpeg','.png','.webp']]
+    return [path]
+
+def run(corpus='testpic',sizes=(500,700,1000),jsonPath='memProfile.json',
+        alienHeadIndex=0,vegetateIndex=0,environmentIndex=1,alienPetIndex=0,traceFrames=8):
+    from ImgGenerateModule import imgGenerator
+    paths=imagePaths(corpus)
+    listener=memoryListener()
+    # models are loaded before tracing, only the allocations of the requests are traced
+    tracemalloc.start(traceFrames)
+    stageListeners.append(listener)
+    try:
+        for size in sizes:
+            imgGenerator.inputSize=size
+            listener.label=size
+            for path in paths:
+                img=cv2.imread(path)
+                if img is None:
+                    print('memProfile: can not read',path)
+                    continue
+                try:
+                    imgGenerator.process(img,alienHeadIndex,vegetateIndex,environmentIndex,alienPetIndex)
+                except Exception as e:
+                    print('memProfile: process error',path,e)
+    finally:
+        stageListeners.remove(listener)
+        tracemalloc.stop()
+    results=summarize(listener.records)
+    printTable(results)
+    with open(jsonPath,'w') as f:
+        json.dump({'time':time.strftime('%Y-%m-%d %H:%M:%S'),'corpus':paths,'sizes':list(sizes),
+                   'stages':results,'records':listener.records},f,indent=1)
+    print('memProfile saved:',jsonPath)
+    return results
+
+if __name__=='__main__':
+    args=sys.argv[1:]
+    corpus=args[0] if len(args)>0 else 'testpic'
+    sizes=[int(size) for size in args[1].split(',')] if len(args)>1 else [500,700,1000]
+    jsonPath=args[2] if len(args)>2 else 'memProfile.json'
+    run(corpus,sizes,jsonPath)
@@ -0,0 +1,105 @@
+import os
+import threading
+import numpy as np
+import paddle
+
+## msgnet(沙化效果)导出为静态图推理模型，CPU上用paddle.inference + oneDNN直接推理，不经过paddlehub的predict
+## 导出: python msgnetInfer.py [hub模型目录] [style图片] [保存路径]
+## 对比: python msgnetInfer.py compare [推理模型路径] [hub模型目录] [style图片] [测试图片]，打印推理模型与hub模型同一输入的最大像素差
+## style的Gram矩阵在导出时固定在模型里，换style图片需要重新导出
+
+class msgnetStatic(paddle.nn.Layer):
+    # msgnet with a fixed style: the Inspiration layer becomes a constant matrix multiply
+    def __init__(self,model):
+        super(msgnetStatic,self).__init__()
+        layers=list(model.model.children())
+        index=[i for i,layer in enumerate(layers) if layer is model.ins]
+        assert len(index)==1,'Inspiration layer not found in msgnet'
+        self.head=paddle.nn.Sequential(*layers[:index[0]])
+        self.tail=paddle.nn.Sequential(*layers[index[0]+1:])
+        ins=model.ins
+        # Inspiration: P=weight*G, feature=P^T*X
+        P=paddle.bmm(ins.weight.expand_as(ins.G),ins.G)
+        PT=P.transpose((0,2,1)).numpy()
+        self.C=PT.shape[1]
+        self.PT=self.create_parameter(shape=PT.shape,dtype='float32',
+                                      default_initializer=paddle.nn.initializer.Assign(PT))
+    def forward(self,x):
+        feature=self.head(x)
+        shape=paddle.shape(feature)
+        feature=paddle.bmm(self.PT,paddle.reshape(feature,[1,self.C,-1]))
+        feature=paddle.reshape(feature,shape)
+        return self.tail(feature)
+
+def exportMsgnet(modelPath='msgnet',stylePath='VegPic/sand.jpg',savePath='msgnetInfer/msgnet'):
+    import paddlehub as hub
+    paddle.disable_static()
+    model=hub.Module(directory=modelPath)
+    style=paddle.to_tensor(model.transform(stylePath).astype('float32')).unsqueeze(0)
+    model.setTarget(style)
+    model.eval()
+    net=msgnetStatic(model)
+    net.eval()
+    # batch 1, any height/width(multiple of 8), BGR float 0~255 NCHW like the hub transform
+    paddle.jit.save(net,savePath,input_spec=[paddle.static.InputSpec(shape=[1,3,None,None],dtype='float32',name='content')])
+    print('msgnet exported:',savePath)
+    return savePath
+
+def compareMsgnet(inferModelPath='msgnetInfer/msgnet',modelPath='msgnet',stylePath='VegPic/sand.jpg',
+                  imagePath='test/input.jpg',maxSide=256):
+    # max pixel difference(0~255) of the exported predictor against the hub model forward, same input as sandModule
+    import cv2
+    import paddlehub as hub
+    paddle.disable_static()
+    model=hub.Module(directory=modelPath)
+    style=paddle.to_tensor(model.transform(stylePath).astype('float32')).unsqueeze(0)
+    model.setTarget(style)
+    model.eval()
+    img=cv2.imread(imagePath)
+    ratio=min(1.0,maxSide/max(img.shape[:2]))
+    width=max(8,int(img.shape[1]*ratio)//8*8)
+    height=max(8,int(img.shape[0]*ratio)//8*8)
+    content=cv2.resize(img,(width,height),interpolation=cv2.INTER_AREA).transpose((2,0,1))[np.newaxis].astype('float32')
+    with paddle.no_grad():
+        expected=model(paddle.to_tensor(content)).numpy()
+    actual=msgnetPredictor(inferModelPath).run(content)
+    diff=int(np.abs(np.clip(actual,0,255).astype('int32')-np.clip(expected,0,255).astype('int32')).max())
+    print('msgnet predictor vs hub forward, input',content.shape,'max pixel diff',diff)
+    return diff
+
+class msgnetPredictor():
+    def __init__(self,inferModelPath='msgnetInfer/msgnet',cpuThreads=None,mkldnn=True,mkldnnCache=16):
+        from paddle import inference
+        config=inference.Config(inferModelPath+'.pdmodel',inferModelPath+'.pdiparams')
+        config.disable_gpu()
+        if mkldnn:
+            config.enable_mkldnn()
+            # the input shape follows the building crop: oneDNN keeps primitives per shape, keep only the latest mkldnnCache
+            config.set_mkldnn_cache_capacity(mkldnnCache)
+        # same budget as the rest of the worker(runtimeTools.applyThreadBudget)
+        if cpuThreads is None:
+            cpuThreads=int(os.getenv('CORES_PER_WORKER','0'))
+        if cpuThreads>0:
+            config.set_cpu_math_library_num_threads(cpuThreads)
+        config.switch_ir_optim(True)
+        config.disable_glog_info()
+        self.predictor=inference.create_predictor(config)
+        self.inputHandle=self.predictor.get_input_handle(self.predictor.get_input_names()[0])
+        self.outputHandle=self.predictor.get_output_handle(self.predictor.get_output_names()[0])
+        self.lock=threading.Lock()# one predictor is not thread safe
+    def run(self,content):
+        # content: float32 [1,3,h,w], return float32 [1,3,h,w]
+        content=np.ascontiguousarray(content,'float32')
+        with self.lock:
+            self.inputHandle.reshape(list(content.shape))
+            self.inputHandle.copy_from_cpu(content)
+            self.predictor.run()
+            return self.outputHandle.copy_to_cpu()
+
+if __name__=='__main__':
+    import sys
+    args=sys.argv[1:]
+    if args[:1]==['compare']:
+        compareMsgnet(*args[1:])
+    else:
+        exportMsgnet(*args)
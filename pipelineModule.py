@@ -0,0 +1,160 @@
+import queue
+import threading
+from concurrent.futures import Future
+import CVTools
+from runtimeTools import stageTimer,stageSummary
+
+## 跨请求的流水线：decode → analyze(分割/人脸关键点) → compose(合成) → encode，每个阶段一个线程池，阶段之间用有界队列连接
+## 请求B的解码、合成可以和请求A的分割同时进行；队列满时前一阶段等待，不会无限堆积
+## 每个阶段的线程数可以按 runtimeTools.stageSummary 的实测耗时调整(tune)
+## stageTimer names measured inside each pipeline stage
+stageTimers={'decode':['decode'],
+             'analyze':['precheck','seg','landmark'],
+             'compose':['head','vegetate','environment','pet'],
+             'encode':['encode']}
+
+def parseSizes(text):
+    # 'decode:1,analyze:1,compose:2' -> {'decode':1,'analyze':1,'compose':2}
+    sizes={}
+    for part in text.split(','):
+        if ':' in part:
+            name,size=part.split(':')
+            sizes[name.strip()]=int(size)
+    return sizes
+
+class pipelineClass():
+    def __init__(self,stages,sizes=None,queueSize=4,limits=None,tuneThreads=0,tuneEvery=100):
+        # stages: [(name, func)], func(item) returns the item for the next stage. sizes: {name: threads}, default 1
+        # limits: {name: max threads} kept by tune. tuneThreads>0: tune with that many threads every tuneEvery items
+        self.names=[name for name,func in stages]
+        self.funcs=dict(stages)
+        self.queues={name:queue.Queue(maxsize=queueSize) for name in self.names}
+        self.limits=limits or {}
+        self.sizes={name:1 for name in self.names}
+        self.sizes.update(self.clamp(sizes or {}))
+        self.alive={name:0 for name in self.names}
+        self.tuneThreads=tuneThreads
+        self.tuneEvery=tuneEvery
+        self.done=0
+        self.lock=threading.Lock()
+        self.closed=False
+        for name in self.names:
+            self.grow(name)
+
+    def clamp(self,sizes):
+        # at least 1 and at most limits[name] threads
+        return {name:max(1,min(self.limits.get(name,size),size)) for name,size in sizes.items()}
+
+    def grow(self,name):
+        # start threads until the stage has sizes[name] of them
+        with self.lock:
+            while self.alive[name]<self.sizes[name]:
+                self.alive[name]+=1
+                threading.Thread(target=self.worker,args=(name,),daemon=True).start()
+
+    def retire(self,name):
+        # True: this thread leaves, the stage has more threads than sizes[name]
+        with self.lock:
+            if self.closed or self.alive[name]>self.sizes[name]:
+                self.alive[name]-=1
+                return True
+            return False
+
+    def worker(self,name):
+        index=self.names.index(name)
+        nextQueue=self.queues[self.names[index+1]] if index+1<len(self.names) else None
+        func=self.funcs[name]
+        while not self.retire(name):
+            try:
+                future,item=self.queues[name].get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                item=func(item)
+            except Exception as e:
+                print('pipeline stage',name,'error:',e)
+                future.set_exception(e)
+                continue
+            if nextQueue is None:
+                future.set_result(item)
+                self.finished()
+            else:
+                nextQueue.put((future,item))# blocks when the next stage is behind
+
+    def finished(self):
+        with self.lock:
+            self.done+=1
+            tune=self.tuneThreads>0 and self.done%self.tuneEvery==0
+        if tune:
+            self.tune(self.tuneThreads)
+
+    def submit(self,item):
+        # Future of the item after the last stage
+        future=Future()
+        self.queues[self.names[0]].put((future,item))
+        return future
+
+    def resize(self,sizes):
+        # {name: threads} within limits, extra threads leave after their current item
+        sizes=self.clamp(sizes)
+        with self.lock:
+            self.sizes.update(sizes)
+        for name in sizes:
+            self.grow(name)
+
+    def tune(self,totalThreads,summary=None):
+        # threads of every stage in proportion to its measured mean time, at least 1
+        summary=stageSummary() if summary is None else summary
+        costs={name:sum([summary[timer]['mean'] for timer in stageTimers.get(name,[name]) if timer in summary])
+               for name in self.names}
+        total=sum(costs.values())
+        if total<=0:
+            return dict(self.sizes)
+        sizes=self.clamp({name:int(round(totalThreads*cost/total)) for name,cost in costs.items()})
+        print('pipeline tune, costs',costs,'sizes',sizes)
+        self.resize(sizes)
+        return sizes
+
+    def close(self):
+        with self.lock:
+            self.closed=True
+
+def imagePipeline(generator,encodeFunc,sizes=None,queueSize=4,limits={'analyze':1},tuneThreads=0):
+    # pipeline of ImgGenerator: item is a dict with 'query', 'params'(of runImg) and what encodeFunc(item) needs
+    # analyze runs the models: limited to 1 thread unless the models are safe to run concurrently
+    # the models compose still runs(msgnet of the environment, landmarks again when analyze found none) lock themselves
+    def decode(item):
+        with stageTimer('decode'):
+            dst=CVTools.base64CV(item['query'])
+        assert dst is not None and len(dst.shape)>2,'decode fail'
+        item['dst']=dst
+        return item
+    def analyze(item):
+        params=item['params']
+        # in load from here to the end of compose, like runImg
+        generator.enterLoad(1)
+        item['blendMode']=generator.blendModeUnderLoad()
+        try:
+            item['analysis']=generator.analyze(item['dst'],params['alienHeadIndex'],params['vegetateIndex'],
+                                               params['environmentIndex'],params['alienPetIndex'],params['allFaces'])
+        except Exception as e:
+            print('pipeline analyze error:',e)
+            item['analysis']={'rc':generator.resultCode[0],'img':[]}
+        return item
+    def compose(item):
+        params=item['params']
+        try:
+            item['rc'],item['img'],item['dic']=generator.compose(item['analysis'],params['alienHeadIndex'],params['vegetateIndex'],
+                                                                 params['environmentIndex'],params['alienPetIndex'],
+                                                                 params['alienPetCount'],params['allFaces'],item['blendMode'])
+        except Exception as e:
+            print('pipeline compose error:',e)
+            item['rc'],item['img'],item['dic']=generator.resultCode[0],[],[]
+        finally:
+            generator.enterLoad(-1)
+        del item['analysis']
+        return item
+    def encode(item):
+        return encodeFunc(item)
+    return pipelineClass([('decode',decode),('analyze',analyze),('compose',compose),('encode',encode)],
+                         sizes,queueSize,limits,tuneThreads)
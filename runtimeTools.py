@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+## 多worker部署时每个worker的CPU线程预算：Paddle, OpenCV, OMP/MKL/BLAS 都由同一个 coresPerWorker 决定
+## 环境变量：CORES_PER_WORKER=线程数(0为不限制)，PIN_CPU=1 每个worker绑定各自的cpu核，WORKER_INDEX=指定worker序号
+threadEnvNames=['OMP_NUM_THREADS','MKL_NUM_THREADS','OPENBLAS_NUM_THREADS','NUMEXPR_NUM_THREADS','VECLIB_MAXIMUM_THREADS','CPU_NUM']
+cpuSlotLockPath='/tmp/superInterstellar_cpu_slot_{}.lock'
+cpuSlotFile=None# keep the lock file open, the slot is released when the worker exits
+
+def setThreadEnv(coresPerWorker):
+    # the BLAS/OMP pools read these only once, so set them before numpy/paddle/cv2 are imported
+    for name in threadEnvNames:
+        os.environ[name]=str(coresPerWorker)
+
+def lockFile(path):
+    # the open file if this process got the lock of path, None if another process has it
+    # keep the file open, the lock is released when the process exits
+    import fcntl
+    f=open(path,'w')
+    try:
+        fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def claimCpuSlot(slotNums):
+    # no worker index from gunicorn, the first slot which is not locked by another worker is ours
+    global cpuSlotFile
+    for index in range(slotNums):
+        f=lockFile(cpuSlotLockPath.format(index))
+        if f is not None:
+            cpuSlotFile=f
+            return index
+    return None
+
+def pinCpu(coresPerWorker,workerIndex=None):
+    allowed=sorted(os.sched_getaffinity(0))
+    slotNums=len(allowed)//coresPerWorker
+    if slotNums==0:
+        return []
+    if workerIndex is None:
+        workerIndex=claimCpuSlot(slotNums)
+        if workerIndex is None:
+            print('no free cpu slot, worker not pinned')
+            return []
+    workerIndex=workerIndex%slotNums
+    cpus=allowed[workerIndex*coresPerWorker:(workerIndex+1)*coresPerWorker]
+    os.sched_setaffinity(0,cpus)
+    return cpus
+
+def applyThreadBudget(coresPerWorker=None,pin=None,workerIndex=None):
+    if coresPerWorker is None:
+        coresPerWorker=int(os.getenv('CORES_PER_WORKER','0'))
+    if pin is None:
+        pin=os.getenv('PIN_CPU','0')=='1'
+    if workerIndex is None and os.getenv('WORKER_INDEX') is not None:
+        workerIndex=int(os.getenv('WORKER_INDEX'))
+    if coresPerWorker<=0:
+        print('thread budget: not limited')
+        return
+    setThreadEnv(coresPerWorker)
+    import cv2
+    cv2.setNumThreads(coresPerWorker)
+    try:
+        import paddle
+        # math library (MKL/OpenBLAS) threads inside paddle cpu kernels
+        paddle.fluid.core.set_num_threads(coresPerWorker)
+    except Exception as e:
+        print('thread budget: paddle threads not set,',e)
+    cpus=pinCpu(coresPerWorker,workerIndex) if pin else []
+    print('thread budget: pid',os.getpid(),'threads',coresPerWorker,'cpus',cpus)
+
+## 各阶段耗时，打印出来并累计，用于调整线程预算
+stageStats={}# name -> [count,total seconds,max seconds]
+stageListeners=[]# objects with begin(name) and end(name,seconds)
+stageLock=threading.Lock()
+
+@contextmanager
+def stageTimer(name):
+    for listener in stageListeners:
+        listener.begin(name)
+    t1=time.time()
+    try:
+        yield
+    finally:
+        seconds=time.time()-t1
+        with stageLock:
+            stat=stageStats.setdefault(name,[0,0.0,0.0])
+            stat[0]+=1
+            stat[1]+=seconds
+            stat[2]=max(stat[2],seconds)
+        print('stage',name,'time %.3f'%seconds)
+        for listener in stageListeners:
+            listener.end(name,seconds)
+
+def stageSummary():
+    # {name: {'count','mean','max'}}
+    with stageLock:
+        return {name:{'count':stat[0],'mean':stat[1]/stat[0],'max':stat[2]} for name,stat in stageStats.items()}
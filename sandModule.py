@@ -1,7 +1,9 @@
-import paddlehub as hub
+import paddle
 import cv2
 import numpy as np
 import os
+import threading
+import CVTools
 #os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 ##
 resultCode=[{99:'运行报错'},
@@ -15,9 +17,20 @@ resultCode=[{99:'运行报错'},
          ]
 ##
 class sandClass():
-    def __init__(self,stylePath='VegPic/sand.jpg',modelPath='msgnet',inputGray=True):
-        self.model = hub.Module(name='msgnet')
-        self.model = hub.Module(directory=modelPath)
+    def __init__(self,stylePath='VegPic/sand.jpg',modelPath='msgnet',inputGray=True,maxSide=256,inferModelPath=None):
+        self.modelPath=modelPath
+        self.model=None
+        ## exported inference model(msgnetInfer.py, style baked in): CPU predictor with oneDNN, paddlehub is not loaded
+        self.predictor=None
+        if inferModelPath is not None and os.path.exists(inferModelPath+'.pdmodel'):
+            try:
+                from msgnetInfer import msgnetPredictor
+                self.predictor=msgnetPredictor(inferModelPath)
+                print('sand uses inference model',inferModelPath)
+            except Exception as e:
+                print('sand inference model not loaded, use paddlehub:',e)
+        if self.predictor is None:
+            self.model=self.loadHub()
         self.stylePath=stylePath
         self.environmentDict={'name':'沙兽族建筑',
                              'descriptions':['沙兽族居住在流沙建造的建筑中，他们通过技术把这些建筑隐藏成普通的人类房子。他们也很少走出他们的房子。'],
@@ -25,6 +38,63 @@ class sandClass():
         self.inputGray =inputGray
         self.resultCode=resultCode
         self.maskIndex=2#building in cityscape
+        ## the style never changes: encode it once, then every request only runs the forward of the content
+        self.maxSide=maxSide # long side of the content fed to msgnet, the result is resized back
+        ## one forward at a time: the environment runs in the compose stage, which may have several threads(pipelineModule.py)
+        self.lock=threading.Lock()
+        self.styleReady=self.predictor is not None or self.setStyle()
+    def loadHub(self):
+        # paddlehub only when there is no exported model, or the predictor fails
+        import paddlehub as hub
+        model = hub.Module(name='msgnet')
+        model = hub.Module(directory=self.modelPath)
+        return model
+    def setStyle(self):
+        try:
+            style=paddle.to_tensor(self.model.transform(self.stylePath).astype('float32')).unsqueeze(0)
+            self.model.setTarget(style)
+            # the forward is called directly, not through predict which sets eval itself
+            self.model.eval()
+            return True
+        except Exception as e:
+            print('sand style target not set, use predict:',e)
+            return False
+    def stylize(self,content):
+        # stylized content(BGR uint8) at most maxSide, same size as content
+        if self.styleReady:
+            try:
+                return cv2.resize(self.forward(content),(content.shape[1],content.shape[0]),interpolation=cv2.INTER_LINEAR)
+            except Exception as e:
+                print('sand forward error, use predict:',e)
+        if self.model is None:
+            self.model=self.loadHub()
+        with self.lock:
+            data = self.model.predict([content], style=self.stylePath, visualization=False)[0]
+        #由正方形输出拉回原来图像比例
+        return cv2.resize(data,(content.shape[1],content.shape[0]),interpolation=cv2.INTER_LINEAR)
+    def comparePredict(self,content):
+        # max pixel difference(0~255) of stylize against paddlehub predict, part of it comes from the input size of predict
+        if self.model is None:
+            self.model=self.loadHub()
+        result=self.stylize(content)
+        with self.lock:
+            data=self.model.predict([content], style=self.stylePath, visualization=False)[0]
+        data=cv2.resize(data,(content.shape[1],content.shape[0]),interpolation=cv2.INTER_LINEAR)
+        return int(np.abs(result.astype('int32')-data.astype('int32')).max())
+    def forward(self,content):
+        ratio=min(1.0,self.maxSide/max(content.shape[:2]))
+        # keep the aspect, msgnet downsamples by 8
+        width=max(8,int(content.shape[1]*ratio)//8*8)
+        height=max(8,int(content.shape[0]*ratio)//8*8)
+        content=cv2.resize(content,(width,height),interpolation=cv2.INTER_AREA)
+        content=content.transpose((2,0,1))[np.newaxis].astype('float32')
+        if self.predictor is not None:
+            output=self.predictor.run(content)
+            return np.clip(output[0].transpose((1,2,0)),0,255).astype('uint8')
+        tensor=paddle.to_tensor(content)
+        with self.lock, paddle.no_grad():
+            output=self.model(tensor)
+        return paddle.clip(output[0].transpose((1,2,0)),0,255).numpy().astype('uint8')
     def run(self,image,mask=[]):
         return self.process(image,mask)
         
@@ -34,44 +104,36 @@ class sandClass():
             dic={}
 
             result = image.copy()
-            if self.inputGray:
-                content = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                content = cv2.cvtColor(content, cv2.COLOR_GRAY2BGR)
-
 
             ## mask process
             if len(mask)==0:
-                rowFirst=0
-                rowLast = content.shape[0]+1
-                colFirst=0
-                colLast = content.shape[1]+1
+                box=[0,0,image.shape[1],image.shape[0]]
             else:
                 if len(mask.shape)==3:
-                    rowFirst, rowLast = noneZeroIndex(mask[:,:,0], 1)
-                    colFirst, colLast = noneZeroIndex(mask[:,:,0], 0)
                     mask=mask[:,:,0]
-                    mask = np.where(mask == self.maskIndex, 1, 0)
-                elif len(mask.shape)==2:
-                    rowFirst, rowLast = noneZeroIndex(mask, 1)
-                    colFirst, colLast = noneZeroIndex(mask, 0)
-                    mask = np.where(mask == self.maskIndex, 1, 0)
-                else:
+                elif len(mask.shape)!=2:
                     return resultCode[7],image,[]
+                # bounding box of the building only
+                box=CVTools.classBox(mask,self.maskIndex)
             ## area match
             #cv2.imwrite(str(np.sum(mask))+'testmask.jpg',mask*255)
-            if np.sum(mask)>0:
-                print('content,mask',content.shape,mask.shape,rowFirst,rowLast,colFirst,colLast)
+            if box is not None:
+                colFirst,rowFirst,colLast,rowLast=box
+                print('content,mask',image.shape,np.shape(mask),rowFirst,rowLast,colFirst,colLast)
+                # gray only on the crop
+                content=image[rowFirst:rowLast,colFirst:colLast,:]
+                if self.inputGray:
+                    content = cv2.cvtColor(content, cv2.COLOR_BGR2GRAY)
+                    content = cv2.cvtColor(content, cv2.COLOR_GRAY2BGR)
                 #
-                data = self.model.predict([content[rowFirst:rowLast,colFirst:colLast,:]], style=self.stylePath, visualization=False)[0]
+                data = self.stylize(content)
                 
                 #print('enviro process',data.shape,mask.shape)
-                #由正方形输出拉回原来图像比例
-                result[rowFirst:rowLast,colFirst:colLast,:]=cv2.resize(data,(colLast-colFirst,rowLast-rowFirst),3)
-                print('result',result.shape)
                 if len(mask)>0:
-                    result[:, :, 0] = np.where(mask == 1, result[:, :, 0], image[:, :, 0])
-                    result[:, :, 1] = np.where(mask == 1, result[:, :, 1], image[:, :, 1])
-                    result[:, :, 2] = np.where(mask == 1, result[:, :, 2], image[:, :, 2])
+                    CVTools.maskedMerge(data,result,mask,self.maskIndex,box)
+                else:
+                    result[rowFirst:rowLast,colFirst:colLast,:]=data
+                print('result',result.shape)
                 rcAll=self.resultCode[4]
                 dic=self.environmentDict
             else:
@@ -101,6 +163,7 @@ if __name__=='__main__':
     mask=np.where(mask>100,2,0)
 
     sc=sandClass()
+    print('stylize vs predict, max pixel diff',sc.comparePredict(image))
     rc,result,des=sc.run(image,mask)
     if list(rc.keys())[0]>=200:
         print(rc)
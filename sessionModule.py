@@ -0,0 +1,217 @@
+import time
+import uuid
+import random
+import threading
+import numpy as np
+import cv2
+import CVTools
+from runtimeTools import stageTimer
+
+## 实时AR会话：客户端用普通HTTP连续发帧(不需要websocket)，服务端保存每个会话的状态
+## 分割只在场景变化时重做(与上次分割帧的dHash距离)，中间帧的分割结果由光流传播
+## 人脸68点用LK光流跟踪，跟丢或每redetectInterval帧才重新检测；外星pet选好位置后跟着光流移动
+## 会话超过ttl秒没有新帧就释放
+class sessionState():
+    def __init__(self,sessionId,alienHeadIndex,vegetateIndex,enviromentIndex,alienPetIndex):
+        self.sessionId=sessionId
+        self.alienHeadIndex=alienHeadIndex
+        self.vegetateIndex=vegetateIndex
+        self.enviromentIndex=enviromentIndex
+        self.alienPetIndex=alienPetIndex
+        self.vegFlip=random.randint(0,1)==1# the same vegetation flip for the whole session
+        self.pred=None # latest segmentation, propagated by the flow between scene changes
+        self.sceneHash=None # dHash of the last segmented frame
+        self.newScene=False # the current frame was segmented
+        self.prevGray=None # small gray of the previous frame for the dense flow
+        self.faceGray=None # gray at working size of the previous frame for the landmark tracking
+        self.landmarks=None # float32 [68,2] of the tracked face
+        self.faceBox=None # [x1,y1,x2,y2] of the tracked face
+        self.sinceDetect=0 # frames since the last landmark detection
+        self.placement=None # pet placement planned on a segmented frame
+        self.offset=np.zeros(2)# moving of the pet since it was planned, [dx,dy]
+        self.dicts=[{},{},{},{}]# [dicHead, dicVeg, dicEnv, dicPet]
+        self.frames=0
+        self.segmentations=0
+        self.lastSeen=time.time()
+        self.lock=threading.Lock()# frames of one session are processed in order
+
+class sessionManager():
+    def __init__(self,generator,ttl=60,maxSessions=16,inputSize=None,sceneThreshold=12,
+                 redetectInterval=30,minTracked=0.8):
+        self.generator=generator
+        self.ttl=ttl # seconds without frame before a session is released
+        self.maxSessions=maxSessions
+        self.inputSize=inputSize or generator.inputSize # working size of the frames
+        self.sceneThreshold=sceneThreshold # dHash hamming distance(of 64 bits) which counts as a new scene
+        self.redetectInterval=redetectInterval # detect the landmarks again after so many tracked frames, against drift
+        self.minTracked=minTracked # ratio of the 68 points LK must track, else detect again
+        self.sessions={}
+        self.lock=threading.Lock()
+
+    def start(self,alienHeadIndex=-1,vegetateIndex=-1,enviromentIndex=-1,alienPetIndex=-1):
+        # return the session id, None if there are too many sessions
+        self.expire()
+        generator=self.generator
+        transHead=getattr(generator,'transHead',None)
+        ## the alien is chosen once for the session
+        if alienHeadIndex==0 and transHead is not None:
+            alienHeadIndex=random.randint(1,len(transHead.charterDict))
+        if vegetateIndex==0 and generator.vegetation is not None:
+            vegetateIndex=random.randint(1,len(generator.vegetation.configDict))
+        session=sessionState(uuid.uuid4().hex,alienHeadIndex,vegetateIndex,enviromentIndex,alienPetIndex)
+        with self.lock:
+            if len(self.sessions)>=self.maxSessions:
+                print('session: too many sessions',len(self.sessions))
+                return None
+            self.sessions[session.sessionId]=session
+        print('session start',session.sessionId,alienHeadIndex,vegetateIndex,enviromentIndex,alienPetIndex)
+        return session.sessionId
+
+    def get(self,sessionId):
+        with self.lock:
+            session=self.sessions.get(sessionId)
+            if session is not None:
+                session.lastSeen=time.time()
+            return session
+
+    def end(self,sessionId):
+        with self.lock:
+            session=self.sessions.pop(sessionId,None)
+        if session is not None:
+            print('session end',sessionId,'frames',session.frames,'segmentations',session.segmentations)
+        return session is not None
+
+    def expire(self):
+        now=time.time()
+        with self.lock:
+            expired=[sessionId for sessionId,session in self.sessions.items() if now-session.lastSeen>self.ttl]
+            for sessionId in expired:
+                del self.sessions[sessionId]
+        if len(expired)>0:
+            print('session expired',expired)
+
+    def segment(self,session,frame,flow):
+        # segmentation again on a new scene, else the last one moved by the flow. return False if seg fails
+        sceneHash=CVTools.dHash(frame)
+        session.newScene=False
+        if session.pred is not None and flow is not None and \
+                CVTools.hammingDistance(sceneHash,session.sceneHash)<=self.sceneThreshold:
+            session.pred=CVTools.propagateMask(session.pred,flow)
+            return True
+        with stageTimer('seg'):
+            # a new scene is segmented by the model, not matched to an older frame in the seg cache
+            rcSeg,pred=self.generator.seg.run(frame,useCache=False)
+        if list(rcSeg.keys())[0]<200:
+            return False
+        print('session',session.sessionId,'new scene, segmentation',session.segmentations)
+        session.pred=pred
+        session.sceneHash=sceneHash
+        session.segmentations+=1
+        session.newScene=True
+        ## new scene: find the face and the pet place again
+        session.landmarks=None
+        session.placement=None
+        session.offset=np.zeros(2)
+        return True
+
+    def trackFace(self,session,frame,gray):
+        # landmarks of the tallest face, tracked from the previous frame by LK, detected when lost
+        landmarks=None
+        if session.landmarks is not None and session.sinceDetect<self.redetectInterval and \
+                session.faceGray.shape==gray.shape:
+            points=session.landmarks.reshape(-1,1,2)
+            moved,status,error=cv2.calcOpticalFlowPyrLK(session.faceGray,gray,points,None,winSize=(21,21),maxLevel=3)
+            status=status.reshape(-1)==1
+            if status.mean()>=self.minTracked:
+                moved=moved.reshape(-1,2)
+                # points LK lost follow the median motion of the tracked ones
+                shift=np.median(moved[status]-session.landmarks[status],axis=0)
+                moved[~status]=session.landmarks[~status]+shift
+                landmarks=moved
+                session.sinceDetect+=1
+        if landmarks is None:
+            with stageTimer('landmark'):
+                dstLM,dstHeight=self.generator.transHead.fl.heightestFace(frame)
+            landmarks=np.array(dstLM,'float32') if len(dstLM)>0 else None
+            session.sinceDetect=0
+        session.landmarks=landmarks
+        session.faceGray=gray
+        if landmarks is None:
+            session.faceBox=None
+        else:
+            x1,y1=np.floor(landmarks.min(axis=0)).astype('int32')
+            x2,y2=np.ceil(landmarks.max(axis=0)).astype('int32')
+            session.faceBox=[int(x1),int(y1),int(x2),int(y2)]
+        return landmarks
+
+    def process(self,session,frame,blendMode=None):
+        # one frame of the session. return rc, img, [dicHead, dicVeg, dicEnv, dicPet], faceBox of this frame
+        # dicts is a copy: the next frame may change the session's while this one is encoded
+        generator=self.generator
+        resultCode=generator.resultCode
+        if frame is None or len(frame.shape)<3:
+            return resultCode[1],[],[],None
+        if np.max(frame.shape[:2])<generator.picSizeLimit:
+            return resultCode[2],[],[],None
+        frame=CVTools.minimizeInput(frame,self.inputSize)
+        gray=CVTools.flowGray(frame)
+        flow=None
+        needSeg=session.vegetateIndex>=0 or session.enviromentIndex>=0 or session.alienPetIndex>=0
+        if needSeg and session.prevGray is not None and session.prevGray.shape==gray.shape:
+            with stageTimer('flow'):
+                flow=CVTools.backFlow(session.prevGray,gray,frame.shape)
+        session.prevGray=gray
+        if needSeg and not self.segment(session,frame,flow):
+            return resultCode[6],[],[],None
+        pred=session.pred
+        rcAll=resultCode[4]
+        img=frame
+        if session.alienHeadIndex>=0 and getattr(generator,'transHead',None) is not None:
+            with stageTimer('head'):
+                landmarks=self.trackFace(session,frame,cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY))
+                if landmarks is None:
+                    rcAll=generator.transHead.resultCode[6]
+                else:
+                    rc,img,dic=generator.transHead.processLandmarks(img,[landmarks],session.alienHeadIndex,blendMode)
+                    if rc==generator.transHead.resultCode[4]:
+                        session.dicts[0]=dic
+                    else:
+                        rcAll=rc
+        if session.vegetateIndex>=0 and generator.vegetation is not None:
+            with stageTimer('vegetate'):
+                rc,imgVeg,dic=generator.vegetation.run(img,session.vegetateIndex,pred,flip=session.vegFlip)
+            if list(rc.keys())[0]>=200:
+                img,session.dicts[1]=imgVeg,dic
+        if session.enviromentIndex>=0 and generator.sander is not None:
+            with stageTimer('environment'):
+                rc,imgEnv,dic=generator.enviromentProcess(session.enviromentIndex,img,pred)
+            if list(rc.keys())[0]>=200:
+                img,session.dicts[2]=imgEnv,dic
+        if session.alienPetIndex>=0:
+            with stageTimer('pet'):
+                if session.placement is None:
+                    # planned only on the segmented frame of a scene, moved by the flow after that
+                    if session.newScene:
+                        session.placement,session.dicts[3]=generator.planFramePet(session.alienPetIndex,img,pred,blendMode)
+                else:
+                    session.offset=generator.followFramePet(session.placement,session.offset,flow)
+                img=generator.blendFramePet(img,pred,session.placement,session.offset)
+            if session.placement is None:
+                rcAll=resultCode[8]
+        session.frames+=1
+        return rcAll,img,list(session.dicts),session.faceBox
+
+    def run(self,sessionId,frame):
+        # return rc, img, dicts, faceBox; None if the session does not exist or has expired
+        self.expire()
+        session=self.get(sessionId)
+        if session is None:
+            return None
+        with session.lock:
+            # session frames count in the load like runImg
+            self.generator.enterLoad(1)
+            try:
+                blendMode=self.generator.blendModeUnderLoad()
+                return self.process(session,frame,blendMode)
+            finally:
+                self.generator.enterLoad(-1)
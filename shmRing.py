@@ -0,0 +1,222 @@
+import os
+import queue
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from contextlib import contextmanager
+from concurrent.futures import Future,TimeoutError as FutureTimeout
+import numpy as np
+import cv2
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None# python<3.8, no worker processes
+
+## HTTP前端与计算worker进程之间的共享内存帧环：前端把上传图片解码、缩放后直接写进slot，
+## worker在slot里读帧、把结果写到同一slot的输出区，进程之间只传slot序号和元数据(shape, 参数, result code)，不pickle图片
+## 环境变量：IMG_WORKERS=worker进程数(0为不用，在flask进程内处理)，IMG_SLOTS=slot数(同时处理的请求数上限)
+class frameRing():
+    # one shared memory block, every slot has an input area and an output area of slotBytes
+    def __init__(self,slots=8,slotBytes=3<<20,name=None):
+        self.slots=slots
+        self.slotBytes=slotBytes
+        self.owner=name is None# the creator unlinks the block
+        self.shm=shared_memory.SharedMemory(name=name,create=self.owner,size=slots*slotBytes*2)
+        self.name=self.shm.name
+
+    def view(self,slot,shape,output=False):
+        # uint8 array of shape inside the slot, no copy
+        if int(np.prod(shape))>self.slotBytes:
+            raise ValueError('frame %s larger than the slot %d bytes'%(str(shape),self.slotBytes))
+        offset=(slot*2+int(output))*self.slotBytes
+        return np.ndarray(tuple(shape),'uint8',buffer=self.shm.buf,offset=offset)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def workerLoop(connection,ringName,slots,slotBytes,inputSize):
+    # compute worker: the models are loaded here, frames come from the ring, results go back into it
+    # connection: the pipe of this worker, (jobId,slot,shape,params) in, (jobId,rc,des,outShape) out
+    from runtimeTools import applyThreadBudget
+    applyThreadBudget()
+    from ImgGenerateModule import imgGenerator
+    imgGenerator.inputSize=inputSize# the front-end downscales with the same size
+    ring=frameRing(slots,slotBytes,ringName)
+    print('shm worker ready, pid',os.getpid())
+    while True:
+        try:
+            job=connection.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        jobId,slot,shape,params=job
+        outShape=None
+        try:
+            rc,img,des=imgGenerator.runImg(ring.view(slot,shape),**params)
+            if len(img)>0:
+                ring.view(slot,img.shape,output=True)[...]=img
+                outShape=img.shape
+        except Exception as e:
+            print('shm worker error:',e)
+            rc,des=imgGenerator.resultCode[0],[]
+        connection.send((jobId,rc,des,outShape))
+    ring.close()
+
+class ringPool():
+    # front-end side: the ring, the worker processes and the results of the jobs in flight
+    # every worker has its own pipe: a worker killed in the middle of a message breaks only its pipe, not the others
+    def __init__(self,workers=2,slots=8,inputSize=700,timeout=120):
+        if shared_memory is None:
+            raise RuntimeError('multiprocessing.shared_memory needs python>=3.8')
+        self.inputSize=inputSize # frames larger than it are downscaled into the slot, the same as CVTools.minimizeInput
+        self.timeout=timeout # seconds to wait for a free slot and for a worker
+        self.slots=slots
+        self.slotBytes=inputSize*inputSize*3
+        self.ring=frameRing(slots,self.slotBytes)
+        self.free=queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        # spawn: forked workers would lose the threads of the loaded models(e.g. the landmark batcher)
+        self.context=multiprocessing.get_context('spawn')
+        self.pending={}# jobId -> Future
+        self.slotOf={}# jobId -> slot, jobs sent to the workers and not ended
+        self.assigned={}# jobId -> index of the worker doing it
+        self.abandoned=set()# jobIds the request stopped waiting for, their slot returns when the job ends
+        self.lock=threading.Lock()
+        self.jobCount=0
+        self.closed=False
+        self.workers=[self.startWorker() for index in range(workers)]# [process, connection, send lock]
+        self.dispatcher=threading.Thread(target=self.dispatch,daemon=True)
+        self.dispatcher.start()
+        print('shm ring:',slots,'slots of',self.slotBytes,'bytes, workers',workers)
+
+    def startWorker(self):
+        connection,workerConnection=self.context.Pipe()
+        process=self.context.Process(target=workerLoop,args=(workerConnection,self.ring.name,self.slots,self.slotBytes,
+                                                             self.inputSize),daemon=True)
+        process.start()
+        workerConnection.close()
+        return [process,connection,threading.Lock()]
+
+    def dispatch(self):
+        while not self.closed:
+            with self.lock:
+                connections=[worker[1] for worker in self.workers]
+            for connection in wait(connections,timeout=1.0):
+                try:
+                    jobId,rc,des,outShape=connection.recv()
+                except (EOFError,OSError):
+                    continue# the worker is gone, checkWorkers starts another
+                self.finish(jobId,result=(rc,des,outShape))
+            self.checkWorkers()
+
+    def finish(self,jobId,result=None,error=None):
+        # a job ended: its request gets the result, or its slot goes back to the ring if nobody waits for it
+        with self.lock:
+            self.assigned.pop(jobId,None)
+            future=self.pending.pop(jobId,None)
+            slot=self.slotOf.pop(jobId,None)
+            abandoned=jobId in self.abandoned
+            self.abandoned.discard(jobId)
+        if abandoned and slot is not None:
+            print('shm ring: late end of job',jobId,', slot',slot,'back to the ring')
+            self.free.put(slot)
+        if future is not None:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def checkWorkers(self):
+        # a crashed worker(segfault, OOM kill) fails its jobs and is started again
+        for index,(process,connection,sendLock) in enumerate(list(self.workers)):
+            if self.closed or process.is_alive():
+                continue
+            print('shm ring: worker',index,'exit code',process.exitcode,', respawn')
+            worker=self.startWorker()
+            with self.lock:
+                self.workers[index]=worker
+                lost=[jobId for jobId,assigned in self.assigned.items() if assigned==index]
+            connection.close()
+            for jobId in lost:
+                self.finish(jobId,error=RuntimeError('shm worker died'))
+
+    def write(self,slot,dst):
+        # decoded upload into the input area of the slot, downscaled there if larger than inputSize
+        height,width=dst.shape[:2]
+        if max(height,width)<=self.inputSize:
+            view=self.ring.view(slot,dst.shape)
+            view[...]=dst
+            return view.shape
+        ratio=self.inputSize/max(height,width)
+        size=(int(round(width*ratio)),int(round(height*ratio)))
+        view=self.ring.view(slot,(size[1],size[0],dst.shape[2]))
+        # fx/fy like CVTools.minimizeInput, so the worker gets exactly the same pixels
+        out=cv2.resize(dst,None,dst=view,fx=ratio,fy=ratio)
+        if out.shape!=view.shape:
+            # size rounded differently by opencv, copy the result in
+            view=self.ring.view(slot,out.shape)
+            view[...]=out
+        return view.shape
+
+    @contextmanager
+    def process(self,dst,**params):
+        # with pool.process(dst,...) as (rc,img,des): img is a view of the slot, valid until the block ends
+        # raise RuntimeError when no slot is free within timeout, TimeoutError of futures when the worker is too slow
+        try:
+            slot=self.free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError('shm ring: no free slot in %g seconds'%self.timeout)
+        owned=True# this request puts the slot back
+        try:
+            shape=self.write(slot,dst)
+            future=Future()
+            with self.lock:
+                self.jobCount+=1
+                jobId=self.jobCount
+                self.pending[jobId]=future
+                self.slotOf[jobId]=slot
+                # the worker with the fewest jobs
+                loads=[0]*len(self.workers)
+                for index in self.assigned.values():
+                    loads[index]+=1
+                index=loads.index(min(loads))
+                self.assigned[jobId]=index
+                process,connection,sendLock=self.workers[index]
+            try:
+                with sendLock:
+                    connection.send((jobId,slot,shape,params))
+            except (OSError,ValueError):
+                self.finish(jobId,error=RuntimeError('shm worker died'))
+            try:
+                rc,des,outShape=future.result(self.timeout)
+            except FutureTimeout:
+                with self.lock:
+                    if jobId in self.slotOf:
+                        # the worker may still write the slot, dispatch puts it back when the job ends
+                        self.abandoned.add(jobId)
+                        self.pending.pop(jobId,None)
+                        owned=False
+                print('shm ring: job',jobId,'timeout, slot',slot)
+                raise
+            img=self.ring.view(slot,outShape,output=True) if outShape is not None else []
+            yield rc,img,des
+        finally:
+            if owned:
+                self.free.put(slot)
+
+    def close(self):
+        self.closed=True
+        for process,connection,sendLock in self.workers:
+            try:
+                with sendLock:
+                    connection.send(None)
+            except (OSError,ValueError):
+                pass
+        for process,connection,sendLock in self.workers:
+            process.join(5)
+            connection.close()
+        self.ring.close()
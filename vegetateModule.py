@@ -3,6 +3,7 @@ import random
 import numpy as np
 import os
 import sys
+import CVTools
 from ConfigVegetae import config as configVeg
 from ConfigVegetae import resultCode
 class vegetateTransClass():
@@ -12,10 +13,19 @@ class vegetateTransClass():
         self.configDict = configVeg['vgetation']
         self.maskIndex=8# cityscape Index of vegetation
         print('self.configDict',self.configDict)
-    def run(self,image,vegetateIndex,mask=[],maskRatio=1):
-        return self.process(image,vegetateIndex,mask,maskRatio)
+        ## style images decoded once, flipped and not flipped
+        self.styles={}
+        for index,cfg in self.configDict.items():
+            style=cv2.imread(os.path.join(self.picPath,cfg['picPath']))[:,:,:3]
+            self.styles[index]={False:style,True:cv2.flip(style,1)}
+    def precheck(self,absentAreas):
+        # 分割前预判：植被区域被判断为不存在时，不用再跑分割
+        return self.maskIndex not in absentAreas
+    def run(self,image,vegetateIndex,mask=[],maskRatio=1,flip=None):
+        return self.process(image,vegetateIndex,mask,maskRatio,flip)
 
-    def process(self,content,vegetateIndex,mask,maskRatio):
+    def process(self,content,vegetateIndex,mask,maskRatio,flip=None):
+        # flip: None random, frames of a clip keep the same one
         try:
             vegetateIndex=int(vegetateIndex)
             dic={}
@@ -23,35 +33,33 @@ class vegetateTransClass():
                 return resultCode[1],content, {}
             elif vegetateIndex==0:
                 vegetateIndex=random.randint(1,len(self.configDict))
-            path=os.path.join(self.picPath,self.configDict[vegetateIndex]['picPath'])
-            style=cv2.imread(path)[:,:,:3]
-            assert  len(style)>0
+            styles=self.styles[vegetateIndex]
             ratio=self.configDict[vegetateIndex]['mixRatio']
             assert (ratio>=0 and ratio<=1)
-            style=randomFlip(style)
+            if flip is None:
+                flip=random.randint(0, 1) ==1
             
             if len(mask)==0:## without mask
-                result=colorTransfer(content, style, ratio=ratio)
+                result=colorTransfer(content, styles[flip], ratio=ratio)
             else:
                 # mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN,cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))                                   )
-                mask=np.where(mask==self.maskIndex,1,0)
+                box=CVTools.classBox(mask,self.maskIndex)
                 ## has suspect area
-                if np.max(mask)>0:
-                    rowFirst, rowLast = noneZeroIndex(mask, 1)
-                    colFirst, colLast = noneZeroIndex(mask, 0)
+                if box is not None:
+                    colFirst,rowFirst,colLast,rowLast=box
                     result = content.copy()
                     #print('rowFirst:rowLast,colFirst:colLast',rowFirst,rowLast,colFirst,colLast)
-                    result[rowFirst:rowLast,colFirst:colLast,:]= \
-                        colorTransfer(result[rowFirst:rowLast,colFirst:colLast,:], style, ratio=ratio)
-
-                    result[:,:,0]=np.where(mask==1,result[:,:,0],content[:,:,0])
-                    result[:,:,1]=np.where(mask==1,result[:,:,1],content[:,:,1])
-                    result[:,:,2]=np.where(mask==1,result[:,:,2],content[:,:,2])
-                    print('result',result.shape,np.max(result))
+                    # the style is aligned to the bounding box, only the pixels of the mask are written back
+                    roi=result[rowFirst:rowLast,colFirst:colLast,:]
+                    inside=(mask[rowFirst:rowLast,colFirst:colLast]==self.maskIndex)[:,:,np.newaxis]
+                    transferred=np.clip(colorTransfer(roi,styles[flip],ratio=ratio),0,255).astype('uint8')
+                    np.copyto(roi,transferred,where=inside)
+                    print('result',result.shape)
                     # cv2.imwrite('roiresult.jpg',result)
 
-                    result=cv2.addWeighted(content,1-maskRatio,result,maskRatio,0)
-                    result=np.array(result,'uint8')
+                    if maskRatio!=1:
+                        result=cv2.addWeighted(content,1-maskRatio,result,maskRatio,0)
+                        result=np.array(result,'uint8')
                     rcAll = self.resultCode[4]
                     dic=self.configDict[vegetateIndex]
                 else:
@@ -100,12 +108,25 @@ def colorTransfer(content,style,ratio=0.5):
     content = cv2.cvtColor(np.float32(content), cv2.COLOR_YUV2BGR)
     return content
 if __name__=='__main__':
+    vt=vegetateTransClass()
+    ## masked result against colorTransfer of the whole box, small boxes too
+    content=cv2.imread('testpic/test0.jpg')
+    for height,width in [(30,50),(100,150),(300,500)]:
+        check=np.zeros(content.shape[:2],'uint8')
+        check[10:10+height,20:20+width]=vt.maskIndex
+        check[10:10+height//2,20:20+width//2]=0
+        rcCheck,imgCheck,desCheck=vt.run(content,1,check,flip=False)
+        box=content[10:10+height,20:20+width]
+        expected=content.copy()
+        expected[10:10+height,20:20+width]=np.clip(colorTransfer(box,vt.styles[1][False],vt.configDict[1]['mixRatio']),0,255)
+        expected=np.where((check==vt.maskIndex)[:,:,np.newaxis],expected,content)
+        print('box',height,width,'max diff',np.abs(imgCheck.astype('int32')-expected).max())
+
     content=cv2.imread('test/input.jpg')
     mask=cv2.imread('test/mask.jpg')
     content=mask
     mask=np.where(mask>100,7,0)[:,:,0]
     style=cv2.imread('testpic/afanda2.jpg')
-    vt=vegetateTransClass()
     rc,img,des=vt.run(content,0,mask)
 
     print(rc)